@@ -0,0 +1,128 @@
+"""Compiled per-event loop of the network (backend='numba'): for each event and each layer, the time surface is read
+around the event in the timestamps of the pixel grid, decayed, masked and filtered, then the layer finds the closest
+prototype (with the homeostatic gain) and learns, in the same order of operations as timesurface.addevent and
+layer.run. Only the time surfaces with 'timestamp' storage and a spatial window (R) are compiled.
+"""
+import numpy as np
+try:
+    from numba import njit
+    NUMBA = True
+except ImportError:
+    NUMBA = False
+    def njit(*args, **kwargs):
+        # without numba the loop stays in python, network falls back on the numpy backend
+        return lambda function: function
+
+EXPONENTIAL, LINEAR = 0, 1
+
+def supported(network):
+    # the compiled loop covers the per-event path except the recording of the stats
+    return NUMBA and not network.stats and all(TS.storage == 'timestamp' and TS.R and TS.decay in ('exponential', 'linear') for TS in network.TS)
+
+def runchunk(network, x, y, t, p, learn):
+    ''' runs the events (x, y, t, p as int64 arrays) through all the layers with the compiled loop and returns the events
+        of the last layer, the state of the time surfaces and layers is updated as with the numpy backend
+    '''
+    TS, L = network.TS, network.L
+    for lay in L:
+        lay.kernel = np.ascontiguousarray(lay.kernel)
+    masks = tuple(TS[i].getmask((2*TS[i].R+1,)*2).astype(np.float64) if TS[i].sigma is not None else np.ones((2*TS[i].R+1,)*2) for i in range(len(TS)))
+    homeo = L[0].homeo
+    state = np.array([[L[i].histosum, L[i].nbtrain] for i in range(len(L))], dtype=np.float64)
+    last = np.zeros([len(TS), 5], dtype=np.int64) # last event (x, y, t, p) and number of events of each time surface
+    events_output = np.zeros([len(x), 4], dtype=np.int64)
+    nbout = loop(x, y, t, p,
+                tuple(TS[i].tmat for i in range(len(TS))),
+                tuple(TS[i].xindex for i in range(len(TS))),
+                tuple(TS[i].yindex for i in range(len(TS))),
+                masks,
+                np.array([TS[i].R for i in range(len(TS))], dtype=np.int64),
+                np.array([TS[i].tau for i in range(len(TS))], dtype=np.float64),
+                np.array([EXPONENTIAL if TS[i].decay == 'exponential' else LINEAR for i in range(len(TS))], dtype=np.int64),
+                np.array([TS[i].kthrs for i in range(len(TS))], dtype=np.float64),
+                np.array([TS[i].filt for i in range(len(TS))], dtype=np.float64),
+                tuple(L[i].kernel for i in range(len(L))),
+                tuple(L[i].colnorm for i in range(len(L))),
+                tuple(L[i].cumhisto for i in range(len(L))),
+                state,
+                np.array([L[i].krnlinit == 'first' for i in range(len(L))]),
+                homeo is not None and homeo is not False,
+                float(homeo[0]) if homeo else 0., float(homeo[1]) if homeo else 0.,
+                learn, last, events_output)
+    for i in range(len(L)):
+        L[i].histosum, L[i].nbtrain = int(state[i,0]), int(state[i,1])
+        if last[i,4]:
+            TS[i].x, TS[i].y, TS[i].t, TS[i].p = [int(value) for value in last[i,:4]]
+            TS[i].iev += int(last[i,4])
+    return events_output[:nbout]
+
+@njit(cache=True)
+def loop(x, y, t, p, tmats, xindexes, yindexes, masks, R, tau, decay, kthrs, filt, kernels, colnorms, cumhistos, state, first, homeo, h0, h1, learn, last, events_output):
+    nblay = len(R)
+    nbout = 0
+    for iev in range(len(x)):
+        xev, yev, tev, pev = x[iev], y[iev], t[iev], p[iev]
+        for lay in range(nblay):
+            tmat, xindex, yindex, mask = tmats[lay], xindexes[lay], yindexes[lay], masks[lay]
+            kernel, colnorm, cumhisto = kernels[lay], colnorms[lay], cumhistos[lay]
+            # timesurface.addevent
+            tmat[pev, xev, yev] = tev
+            last[lay, 0], last[lay, 1], last[lay, 2], last[lay, 3] = xev, yev, tev, pev
+            last[lay, 4] += 1
+            nbpol, side = tmat.shape[0], 2*R[lay]+1
+            # the time surface has the precision of the kernels, the decay and mask are computed in float64 as in numpy
+            timesurf = np.zeros(nbpol*side*side, dtype=kernel.dtype)
+            card = 0
+            for pol in range(nbpol):
+                for i in range(side):
+                    xi = xindex[xev+i]
+                    for j in range(side):
+                        dt = tev-tmat[pol, xi, yindex[yev+j]]
+                        if decay[lay] == 0:
+                            value = np.exp(-dt/tau[lay])
+                            # making threshold for small elements
+                            if value<np.exp(-kthrs[lay]):
+                                value = 0.
+                        else:
+                            value = max(1-dt/tau[lay], 0.)
+                        timesurf[(pol*side+i)*side+j] = value
+                        timesurf[(pol*side+i)*side+j] *= mask[i, j]
+                        if pol == pev and timesurf[(pol*side+i)*side+j] != 0:
+                            card += 1
+            if not card>filt[lay]*side*side/nbpol:
+                break
+            # layer.run
+            N = kernel.shape[1]
+            if first[lay] and state[lay, 1]<N:
+                k = int(state[lay, 1])
+                norm = 0.
+                for d in range(len(timesurf)):
+                    kernel[d, k] = timesurf[d]
+                    norm += timesurf[d]*timesurf[d]
+                colnorm[k] = norm
+                state[lay, 1] += 1
+            else:
+                normTS = np.sqrt(np.sum(timesurf*timesurf))
+                kernelnorm = np.sqrt(np.sum(colnorm))
+                simil = np.dot(timesurf, kernel)/(normTS*kernelnorm)
+                if homeo:
+                    gain = np.exp(h0*N**h1*(1-cumhisto*(N/state[lay, 0])))
+                    k = np.argmax(simil*gain)
+                else:
+                    k = np.argmax(simil)
+                if learn:
+                    alpha = 0.01/(1+cumhisto[k]/20000)
+                    norm = 0.
+                    for d in range(len(timesurf)):
+                        Ck_t = kernel[d, k]+alpha*simil[k]*(timesurf[d]-kernel[d, k])
+                        kernel[d, k] = Ck_t
+                        norm += Ck_t*Ck_t
+                    colnorm[k] = norm
+                    state[lay, 1] += 1
+                cumhisto[k] += 1
+                state[lay, 0] += 1
+            pev = k
+            if lay == nblay-1:
+                events_output[nbout, 0], events_output[nbout, 1], events_output[nbout, 2], events_output[nbout, 3] = xev, yev, tev, pev
+                nbout += 1
+    return nbout
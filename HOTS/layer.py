@@ -5,7 +5,7 @@ import matplotlib.pyplot as plt
 class layer(object):
     """layer makes the computations within a layer of the HOTS network based on the methods from Lagorce et al. 2017, Maro et al. 2020 or the Matching Pursuit algorithm.
     """
-    def __init__(self, R, N_clust, nbpola, homeo, algo, krnlinit, camsize, to_record):
+    def __init__(self, R, N_clust, nbpola, homeo, algo, krnlinit, camsize, to_record, dtype=np.float64):
         self.to_record = to_record
         self.R = R
         self.homeo = homeo       # gives the parameters of the homeostasis rule (None if no homeostasis)
@@ -18,15 +18,42 @@ class layer(object):
         else:
             self.kernel = np.random.rand(nbpola*camsize[0]*camsize[1], N_clust)
             self.kernel /= np.linalg.norm(self.kernel)
+        # the kernels (and their norms) are stored with the precision of the time surfaces, the histogram of activation
+        # stays in float64 to count the events exactly
+        self.kernel = self.kernel.astype(dtype)
         self.cumhisto = np.ones([N_clust])
-        
+        self.histosum = N_clust  # sum of cumhisto
+        self.setnorm()
+
+    def __setstate__(self, state):
+        # layers saved before the norms were cached
+        self.__dict__.update(state)
+        if not hasattr(self, 'colnorm'):
+            self.setnorm()
+            self.histosum = np.sum(self.cumhisto)
+
+    def setnorm(self):
+        ''' computes the squared norms of all kernels, only the one of the kernel modified by the learning step is
+            updated afterwards
+        '''
+        self.colnorm = np.sum(self.kernel**2, axis=0)
+
+    def kernelnorm(self):
+        ''' returns the norm of the whole dictionary from the cached norms of the kernels
+        '''
+        return np.sqrt(np.sum(self.colnorm))
+
+    def reset(self):
+        ''' sets the histogram of activation to its initial value
+        '''
+        self.cumhisto[:] = 1
+        self.histosum = len(self.cumhisto)
+
     def homeorule(self):
         ''' defines the homeostasis rule
         '''
-        histo = self.cumhisto.copy()
-        histo/=np.sum(histo)
-
-        gain = np.exp(self.homeo[0]*self.kernel.shape[1]**self.homeo[1]*(1-histo*self.kernel.shape[1]))
+        N = self.kernel.shape[1]
+        gain = np.exp(self.homeo[0]*N**self.homeo[1]*(1-self.cumhisto*(N/self.histosum)))
         return gain
         
     
@@ -37,12 +64,15 @@ class layer(object):
         '''
         if self.krnlinit=='first':
             while self.nbtrain<self.kernel.shape[1]:
+                if self.to_record:
+                    self.krnlprev = self.kernel[:,self.nbtrain].copy()
                 self.kernel[:,self.nbtrain]=TS.T
+                self.colnorm[self.nbtrain] = np.dot(TS,TS)
                 p = self.nbtrain
                 self.nbtrain += 1
                 return p
 
-        simil = np.dot(TS,self.kernel)/(np.linalg.norm(TS)*np.linalg.norm(self.kernel))
+        simil = np.dot(TS,self.kernel)/(np.linalg.norm(TS)*self.kernelnorm())
 
         if self.homeo:
             gain = self.homeorule()
@@ -50,20 +80,108 @@ class layer(object):
         else:
             closest_proto_idx = np.argmax(simil)
 
+        if self.to_record:
+            # only the kernel of the closest prototype (the one modified by learning) is kept for the stats
+            self.krnlprev = self.kernel[:,closest_proto_idx].copy()
+
         if learn:
             Ck = self.kernel[:,closest_proto_idx]
             alpha = 0.01/(1+self.cumhisto[closest_proto_idx]/20000)
             Ck_t = Ck + alpha*simil[closest_proto_idx]*(TS - Ck)
             #Ck_t = Ck + alpha*(TS - simil[closest_proto_idx]*Ck)
             self.kernel[:,closest_proto_idx] = Ck_t
+            self.colnorm[closest_proto_idx] = np.dot(Ck_t,Ck_t)
 
         p = closest_proto_idx
         self.cumhisto[closest_proto_idx] += 1
+        self.histosum += 1
         if learn:
             self.nbtrain += 1
         
         return p
-    
+
+    def predict_batch(self, TS):
+        '''runs the layer with frozen kernels (same as run with learn=False) on a matrix of time surfaces (one per row)
+           and returns the indices of the closest prototypes
+        '''
+        TS = np.asarray(TS)
+        closest_proto_idx = np.zeros(len(TS), dtype=int)
+        start = 0
+        if self.krnlinit=='first':
+            # the kernels not initialized yet take the first time surfaces as in run, even with learn=False
+            while self.nbtrain<self.kernel.shape[1] and start<len(TS):
+                closest_proto_idx[start] = self.run(TS[start], False)
+                start += 1
+        TS = TS[start:]
+        if not len(TS):
+            return closest_proto_idx
+
+        simil = np.dot(TS,self.kernel)/(np.linalg.norm(TS,axis=1)[:,None]*self.kernelnorm())
+
+        if self.homeo:
+            # the gain changes with the histogram of activation at each event
+            for iev in range(len(TS)):
+                gain = self.homeorule()
+                closest_proto_idx[start+iev] = np.argmax(simil[iev]*gain)
+                self.cumhisto[closest_proto_idx[start+iev]] += 1
+                self.histosum += 1
+        else:
+            closest_proto_idx[start:] = np.argmax(simil, axis=1)
+            self.cumhisto += np.bincount(closest_proto_idx[start:], minlength=len(self.cumhisto))
+            self.histosum += len(TS)
+
+        return closest_proto_idx
+
+    def learn_batch(self, TS):
+        '''learns the kernels on a mini-batch of time surfaces (one per row) and returns the indices of the closest
+           prototypes. The time surfaces are assigned with the kernels and the homeostatic gain of the beginning of
+           the mini-batch, then each kernel makes at once the sequence of updates of run with its own time surfaces
+        '''
+        TS = np.asarray(TS)
+        N = self.kernel.shape[1]
+        closest_proto_idx = np.zeros(len(TS), dtype=int)
+        start = 0
+        if self.krnlinit=='first':
+            # the first time surfaces initialize the kernels as in run
+            while self.nbtrain<N and start<len(TS):
+                closest_proto_idx[start] = self.run(TS[start], True)
+                start += 1
+        TS = TS[start:]
+        if not len(TS):
+            return closest_proto_idx
+
+        simil = np.dot(TS,self.kernel)/(np.linalg.norm(TS,axis=1)[:,None]*self.kernelnorm())
+        if self.homeo:
+            p = np.argmax(simil*self.homeorule(), axis=1)
+        else:
+            p = np.argmax(simil, axis=1)
+        closest_proto_idx[start:] = p
+
+        # time surfaces grouped by kernel, in the order of the events
+        order = np.argsort(p, kind='stable')
+        ps = p[order]
+        counts = np.bincount(ps, minlength=N)
+        starts = np.cumsum(counts)-counts
+        rank = np.arange(len(ps))-starts[ps]
+        # alpha follows the histogram of activation of the kernel along its updates
+        alpha = 0.01/(1+(self.cumhisto[ps]+rank)/20000)
+        step = alpha*simil[order,ps]
+        # Ck_t = Ck + step*(TS - Ck) repeated over the n time surfaces of a kernel gives
+        # Ck_n = prod_i(1-step_i)*Ck + sum_i step_i*prod_{j>i}(1-step_j)*TS_i
+        logkeep = np.log1p(-step)
+        after = np.append(np.cumsum(logkeep[::-1])[::-1], 0)
+        weights = step*np.exp(after[1:]-after[(starts+counts)[ps]])
+        decay = np.exp(after[starts]-after[starts+counts])
+        W = np.zeros([len(TS), N], dtype=self.kernel.dtype)
+        W[order,ps] = weights
+        self.kernel = self.kernel*decay.astype(self.kernel.dtype)+np.dot(TS.T,W)
+        self.setnorm()
+
+        self.cumhisto += counts
+        self.histosum += len(TS)
+        self.nbtrain += len(TS)
+        return closest_proto_idx
+
 ##____________PLOTTING_________________________________________________________________________
     
     def plotdicpola(lay, pola, R):
@@ -6,11 +6,28 @@ from HOTS.stats import stats
 from tqdm import tqdm
 import os
 import pickle
+import shutil
+import multiprocessing
+from collections import deque
+
+# size of the time surfaces (nbpol*(2R+1)**2) up to which a layer with frozen kernels runs faster on a whole chunk
+# (timesurface.batch_surfaces and layer.predict_batch) than event by event, the two paths are even between 2312 and
+# 4624 (see notebooks/benchmark_runchunk.py)
+BATCH_MAXDIM = 2500
 
 class network(object):
     """network is an Hierarchical network described in Lagorce et al. 2017 (HOTS).
     METHODS:
              .running -> runs the network from a loader and saves stream of events as output (learn=False), or a network with trained weights (learn=True)
+                        (with learn=False, n_jobs>1 processes the samples in parallel and output='consolidated' stores
+                        all the events of the split in one file with the offsets and targets of the samples)
+             .stream -> runs the network on one recording given as an array of events (or an iterable of chunks of events)
+                        and yields the output events (x, y, t, p) chunk by chunk
+             .runchunk -> runs a chunk of events through all the layers and returns the events of the last layer
+                        (with frozen kernels, the layers with time surfaces up to BATCH_MAXDIM run on the whole chunk,
+                        with learn_batch, the kernels are learned on mini-batches of time surfaces layer by layer,
+                        with backend='numba' the events go one by one through a compiled loop)
+             .runlayer -> runs the events of a chunk one by one through a layer with frozen kernels
              .get_fname -> returns the name of the network depending on its parameters
              .plotlayer -> plots the histogram of activation of the different layers ad associated kernels
              .plotconv -> plots the convergence of the layers during learning phase
@@ -26,10 +43,26 @@ class network(object):
                         R = (2,4,8), # parameter defining the spatial size of the time surface
                         homeo = (.25,1), # parameters for homeostasis (None is no homeo rule)
                         camsize = (34,34), # size of the pixel grid that recorded the event stream
-                        to_record = False
+                        storage = 'timestamp', # state of the time surfaces ('timestamp' stores the last event of each pixel, 
+                                               # 'grid' decays the whole pixel grid at each event)
+                        to_record = False,
+                        learn_batch = None, # size of the mini-batches of time surfaces for learning with 'timestamp' storage
+                                            # (None is sequential learning, the kernels are updated at each event)
+                        backend = 'numpy', # 'numba' runs the per-event loop compiled with numba (if installed)
+                        dtype = np.float64 # precision of the time surfaces, kernels and classifier (np.float32 halves the
+                                           # memory of the state, see results.precision_check for the tolerance)
                 ):
         self.name = name
         self.date = timestr
+        self.learn_batch = learn_batch
+        if backend == 'numba':
+            # numba is only imported when the compiled backend is asked for
+            from HOTS import jit
+            if not jit.NUMBA:
+                print('numba is not installed, the network runs with the numpy backend')
+                backend = 'numpy'
+        self.backend = backend
+        self.dtype = dtype
         if self.name == 'hots':
             # replicates methods from Lagorce et al. 2017
             algo, decay, krnlinit, homeo, sigma = 'lagorce', 'exponential', 'first', None, None
@@ -51,24 +84,29 @@ class network(object):
             self.stats = [[]]*nblay
         for lay in range(nblay):
             if lay == 0:
-                self.TS[lay] = timesurface(R[lay], tau[lay], camsize, nbpolcam, sigma, decay)
-                self.L[lay] = layer(R[lay], nbclust[lay], nbpolcam, homeo, algo, krnlinit, camsize, to_record)
+                self.TS[lay] = timesurface(R[lay], tau[lay], camsize, nbpolcam, sigma, decay, storage, dtype)
+                self.L[lay] = layer(R[lay], nbclust[lay], nbpolcam, homeo, algo, krnlinit, camsize, to_record, dtype)
                 if to_record:
-                    self.stats[lay] = stats(nbclust[lay], camsize)
+                    self.stats[lay] = stats(nbclust[lay], camsize, dtype)
             else:
-                self.TS[lay] = timesurface(R[lay], tau[lay], camsize, nbclust[lay-1], sigma, decay)
-                self.L[lay] = layer(R[lay], nbclust[lay], nbclust[lay-1], homeo, algo, krnlinit, camsize, to_record)
+                self.TS[lay] = timesurface(R[lay], tau[lay], camsize, nbclust[lay-1], sigma, decay, storage, dtype)
+                self.L[lay] = layer(R[lay], nbclust[lay], nbclust[lay-1], homeo, algo, krnlinit, camsize, to_record, dtype)
                 if to_record:
-                    self.stats[lay] = stats(nbclust[lay], camsize)
+                    self.stats[lay] = stats(nbclust[lay], camsize, dtype)
+
+    def __setstate__(self, state):
+        # networks saved before the learn_batch, backend and dtype options
+        self.__dict__.update(state)
+        if not hasattr(self, 'learn_batch'):
+            self.learn_batch = None
+        if not hasattr(self, 'backend'):
+            self.backend = 'numpy'
+        if not hasattr(self, 'dtype'):
+            self.dtype = np.float64
 
 ##___________________________________________________________________________________________
 
-    def running(self, loader, ordering, classes, train=True, learn=False, jitter=None, verbose=True):
-        
-        x_index = ordering.index('x')
-        y_index = ordering.index('y')
-        t_index = ordering.index('t')
-        p_index = ordering.index('p')
+    def running(self, loader, ordering, classes, train=True, learn=False, jitter=None, verbose=True, n_jobs=1, output='files'):
         
         if learn:
             model, loaded = self.load_model(verbose)
@@ -86,54 +124,159 @@ class network(object):
             if os.path.exists(output_path):
                 if verbose: print(f'this dataset have already been processed, check at: \n {output_path}')
                 return
+            # the split is written in a temporary directory renamed once all the samples are stored, the output
+            # directory of an interrupted run does not exist and the split is processed again by the next call
+            build_path = output_path[:-1]+'.tmp/'
+            if os.path.exists(build_path):
+                shutil.rmtree(build_path)
+            if output == 'consolidated':
+                # all the events of the split are stored in one file, the samples are indexed by their offsets
+                os.makedirs(build_path)
+                store = open(build_path+'events.dat', 'wb')
+                offsets, targets = [0], []
             else:
                 for classe in classes:
-                    os.makedirs(output_path+f'{classe}')
+                    os.makedirs(build_path+f'{classe}')
             
         pbar = tqdm(total=len(loader))
         nb = 0
-        for events, target in loader:
-            no_output = 0
-            events_output = np.zeros([4])
-            events = events.squeeze()
-            pbar.update(1)
-            for i in range(len(self.L)):
-                self.TS[i].spatpmat[:] = 0
-                self.TS[i].iev, self.TS[i].x, self.TS[i].y, self.TS[i].t, self.TS[i].p = 0,0,0,0,0
-                self.L[i].cumhisto[:] = 1
-                if self.stats:
-                    self.stats[i].actmap[:] = 0
-            for iev in range(len(events)):
-                x, y, t, p = int(events[iev][x_index].item()), int(events[iev][y_index].item()), int(events[iev][t_index].item()), int(events[iev][p_index].item())
+        if n_jobs>1 and not learn:
+            # with frozen kernels the samples are independent, each worker runs its own copy of the network
+            pool = multiprocessing.Pool(n_jobs, initializer=initworker, initargs=(self, ordering))
+            outputs = bounded_imap(pool, runworker, ((np.asarray(events.squeeze()), target) for events, target in loader), 2*n_jobs)
+        else:
+            pool = None
+            outputs = ((list(self.stream(events.squeeze(), ordering, learn)), target) for events, target in loader)
+        # the outputs come in the order of the loader so that the numbering of the files does not depend on n_jobs
+        try:
+            for events_output, target in outputs:
+                pbar.update(1)
+                # the output chunks are concatenated once at the end of the sample
+                if not learn and len(events_output)>0:
+                    events_output = np.concatenate(events_output)
+                    if output == 'consolidated':
+                        store.write(events_output.astype(np.int64).tobytes())
+                        offsets.append(offsets[-1]+len(events_output))
+                        targets.append(int(target))
+                    else:
+                        np.save(build_path+f'{classes[target]}/{nb}', events_output)
+                    nb+=1
+        except BaseException:
+            # on an error or an interruption the workers are stopped without waiting for the samples in flight
+            if pool:
+                pool.terminate()
+                pool.join()
+            if not learn and output == 'consolidated':
+                store.close()
+            pbar.close()
+            raise
+        if pool:
+            pool.close()
+            pool.join()
+        if not learn and output == 'consolidated':
+            store.close()
+            np.save(build_path+'offsets', np.array(offsets, dtype=np.int64))
+            np.save(build_path+'targets', np.array(targets, dtype=np.int64))
+            np.save(build_path+'classes', np.array(classes))
+        if not learn:
+            os.rename(build_path, output_path)
+        pbar.close()
+        if learn:
+            self.save_model()
+
+    def stream(self, events, ordering='xytp', learn=False, chunksize=1000):
+        # the state of the time surfaces and layers is reset at the beginning of the recording and kept between chunks
+        for i in range(len(self.L)):
+            self.TS[i].reset()
+            self.L[i].reset()
+            if self.stats:
+                self.stats[i].actmap[:] = 0
+        if learn and self.learn_batch:
+            chunksize = max(chunksize, self.learn_batch)
+        if hasattr(events, 'shape'):
+            chunks = (events[i:i+chunksize] for i in range(0, len(events), chunksize))
+        else:
+            chunks = events
+        for chunk in chunks:
+            events_output = self.runchunk(chunk, ordering, learn)
+            if len(events_output):
+                yield events_output
+
+    def runchunk(self, events, ordering='xytp', learn=False):
+        events = np.asarray(events)
+        if events.dtype.names:
+            x, y, t, p = [events[name].astype(np.int64) for name in ['x','y','t','p']]
+        else:
+            x, y, t, p = [events[:,ordering.index(name)].astype(np.int64) for name in ['x','y','t','p']]
+        if self.backend == 'numba' and not (learn and self.learn_batch):
+            from HOTS import jit
+            if jit.supported(self):
+                # the whole per-event update of all layers is compiled
+                return jit.runchunk(self, x, y, t, p, learn)
+        if (learn and not self.learn_batch) or self.stats or any(TS.storage != 'timestamp' for TS in self.TS):
+            # learning and recording are sequential, each event goes through all layers before the next one
+            events_output = np.zeros([len(x),4], dtype=np.int64)
+            nbout = 0
+            for iev in range(len(x)):
+                xev, yev, tev, pev = int(x[iev]), int(y[iev]), int(t[iev]), int(p[iev])
                 for lay in range(len(self.L)):
-                    dic_prev = self.L[lay].kernel.copy()
-                    timesurf = self.TS[lay].addevent(x, y, t, p)
-                    if np.isnan(timesurf).sum()>0:
-                        #self.plote()
-                        print(iev)
+                    timesurf = self.TS[lay].addevent(xev, yev, tev, pev)
                     if len(timesurf)>0:
-                        p = self.L[lay].run(timesurf, learn)
+                        pev = self.L[lay].run(timesurf, learn)
                         if self.stats:
-                            self.stats[lay].actmap[p,x,y] = 1
-                            self.stats[lay].update(p, self.L[lay].kernel, timesurf, self.TS[lay].tau, dic_prev)
+                            self.stats[lay].actmap[pev,xev,yev] = 1
+                            self.stats[lay].update(pev, self.L[lay].kernel, timesurf, self.TS[lay].tau, self.L[lay].krnlprev)
                         if lay==len(self.TS)-1:
-                            events_output = np.vstack((events_output, np.array([x,y,t,p])))
+                            events_output[nbout] = [xev,yev,tev,pev]
+                            nbout += 1
                     else:
-                        #no_output += 1
-                        #print(f'{no_output} events did not reach the output layer, total number of events: {len(events)}', end='\r')
                         break
-            if not learn and len(events_output.shape)>1:
-                np.save(output_path+f'{classes[target]}/{nb}', events_output)
-                nb+=1
-        pbar.close()
-        if learn:
-            self.save_model()
+            return events_output[:nbout]
+        # with frozen kernels (or mini-batch learning) the whole chunk goes through a layer before the next one
+        order = np.argsort(t, kind='stable')
+        x, y, t, p = x[order], y[order], t[order], p[order]
+        for lay in range(len(self.L)):
+            if not learn and self.L[lay].kernel.shape[0]>BATCH_MAXDIM:
+                # large time surfaces are faster event by event than on the whole chunk
+                activ, p = self.runlayer(lay, x, y, t, p)
+                x, y, t = x[activ], y[activ], t[activ]
+                continue
+            chunk = np.zeros(len(x), dtype=[('x',np.int64),('y',np.int64),('t',np.int64),('p',np.int64)])
+            chunk['x'], chunk['y'], chunk['t'], chunk['p'] = x, y, t, p
+            timesurf, activ = self.TS[lay].batch_surfaces(chunk, dtype=self.dtype)
+            x, y, t = x[activ], y[activ], t[activ]
+            if learn:
+                # the time surfaces only depend on the events, the kernels are learned on successive mini-batches
+                timesurf = timesurf[activ]
+                p = np.zeros(len(timesurf), dtype=int)
+                for i in range(0, len(timesurf), self.learn_batch):
+                    p[i:i+self.learn_batch] = self.L[lay].learn_batch(timesurf[i:i+self.learn_batch])
+            else:
+                p = self.L[lay].predict_batch(timesurf[activ])
+        return np.stack([x, y, t, p], axis=1)
+
+    def runlayer(self, lay, x, y, t, p):
+        ''' runs the events of a chunk one by one through a layer with frozen kernels and returns the activity mask of
+            the events and the polarities of the active ones
+        '''
+        activ = np.zeros(len(x), dtype=bool)
+        pout = np.zeros(len(x), dtype=int)
+        for iev in range(len(x)):
+            timesurf = self.TS[lay].addevent(int(x[iev]), int(y[iev]), int(t[iev]), int(p[iev]))
+            if len(timesurf)>0:
+                activ[iev] = True
+                pout[iev] = self.L[lay].run(timesurf, False)
+        return activ, pout[activ]
 
     def get_fname(self):
         arch = [self.L[i].kernel.shape[1] for i in range(len(self.L))]
         R = [self.L[i].R for i in range(len(self.L))]
         tau = [np.round(self.TS[i].tau*1e-3,2) for i in range(len(self.TS))]
         f_name = f'{self.date}_{self.name}_{self.L[0].homeo}_{arch}_{tau}_{R}'
+        if self.learn_batch:
+            f_name += f'_batch{self.learn_batch}'
+        if np.dtype(self.dtype) != np.float64:
+            f_name += f'_{np.dtype(self.dtype).name}'
         return f_name
 
     def save_model(self):
@@ -141,8 +284,10 @@ class network(object):
         if not os.path.exists(path):
             os.makedirs(path)
         f_name = path+self.get_fname()+'.pkl'
-        with open(f_name, 'wb') as file:
+        # written aside and renamed so that load_model never finds a truncated model
+        with open(f_name+'.tmp', 'wb') as file:
             pickle.dump(self, file, pickle.HIGHEST_PROTOCOL)
+        os.replace(f_name+'.tmp', f_name)
 
     def load_model(self, verbose):
         loaded = False
@@ -159,10 +304,10 @@ class network(object):
     def sensformat(self,sensor_size):
         for i in range(1,len(self.TS)):
             self.TS[i].camsize = sensor_size
-            self.TS[i].spatpmat = np.zeros((self.L[i-1].kernel.shape[1],sensor_size[0]+1,sensor_size[1]+1))
+            self.TS[i].allocate((self.L[i-1].kernel.shape[1],sensor_size[0]+1,sensor_size[1]+1))
             self.stats[i].actmap = np.zeros((self.L[i-1].kernel.shape[1],sensor_size[0]+1,sensor_size[1]+1))
         self.TS[0].camsize = sensor_size
-        self.TS[0].spatpmat = np.zeros((2,sensor_size[0]+1,sensor_size[1]+1))
+        self.TS[0].allocate((2,sensor_size[0]+1,sensor_size[1]+1))
         self.stats[0].actmap = np.zeros((2,sensor_size[0]+1,sensor_size[1]+1))
 
 
@@ -246,7 +391,7 @@ class network(object):
     def plotTS(self, maxpol=None):
         N = []
         for i in range(len(self.TS)):
-            N.append(int(self.TS[i].spatpmat.shape[1]))
+            N.append(int(self.TS[i].getspatpmat().shape[1]))
 
         fig = plt.figure(figsize=(16,5))
         gs = fig.add_gridspec(len(self.TS), np.max(N), wspace=0.05, hspace=0.05)
@@ -255,7 +400,32 @@ class network(object):
         for i in range(len(self.TS)):
             for k in range(N[i]):
                 axi = fig.add_subplot(gs[i,k])
-                axi.imshow(self.TS[i].spatpmat, cmap=plt.cm.plasma, interpolation='nearest')
+                axi.imshow(self.TS[i].getspatpmat(), cmap=plt.cm.plasma, interpolation='nearest')
                 axi.set_xticks(())
                 axi.set_yticks(())
-    
\ No newline at end of file
+    
+
+##___________________PARALLEL INFERENCE______________________________________________________
+##___________________________________________________________________________________________
+
+worker_network, worker_ordering = None, None
+
+def initworker(network, ordering):
+    # each worker of the pool keeps its own copy of the network (frozen kernels and state of the time surfaces)
+    global worker_network, worker_ordering
+    worker_network, worker_ordering = network, ordering
+
+def runworker(sample):
+    events, target = sample
+    return list(worker_network.stream(events, worker_ordering)), target
+
+def bounded_imap(pool, function, iterable, max_tasks):
+    # same as pool.imap (results in the order of the iterable) with at most max_tasks items submitted and not yet
+    # consumed, the loader is read as fast as the outputs are saved instead of being decoded ahead in memory
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(function, (item,)))
+        if len(pending)>=max_tasks:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
@@ -1,4 +1,5 @@
 from HOTS.Network import network
+from HOTS.tools import score_accumulator
 import torch
 from torch.utils.data import Dataset, TensorDataset, DataLoader, SubsetRandomSampler
 import pickle
@@ -509,35 +510,13 @@ def classification_results(likelihood, true_target, thres, nb_test, chance, verb
     elif len(true_target)>nb_test:
         meanac, onlinac, lastac, truepos, falsepos = np.nan, np.nan, np.nan, np.nan, np.nan
     else:
-        matscor = np.zeros([len(true_target),30000])
-        matscor[:] = np.nan
-        sample = 0
-        lastac = 0
-
+        # the scores are accumulated sample by sample, without limit on the number of events
+        scores = score_accumulator(thres=thres)
         for likelihood_, true_target_ in zip(likelihood, true_target):
-            if len(likelihood_)==0:
-                sample+=1
-            else:
-                pred_target = np.zeros(len(likelihood_))
-                pred_target[:] = np.nan
-                if not thres:
-                    pred_target = np.argmax(likelihood_, axis = 1)
-                else:
-                    for i in range(len(likelihood_)):
-                        if np.max(likelihood_[i])>thres:
-                            pred_target[i] = np.argmax(likelihood_[i])
-                for event in range(len(pred_target)):
-                    if np.isnan(pred_target[event])==False:
-                        matscor[sample,event] = pred_target[event]==true_target_
-                if pred_target[-1]==true_target_:
-                    lastac+=1
-                sample+=1
-
-        meanac = np.nanmean(matscor)
-        onlinac = np.nanmean(matscor, axis=0)
-        lastac/=nb_test
-        truepos = len(np.where(matscor==1)[0])
-        falsepos = len(np.where(matscor==0)[0])
+            if len(likelihood_)>0:
+                scores.update(likelihood_, true_target_)
+        meanac, onlinac, _, truepos, falsepos = scores.results()
+        lastac = scores.nb_last/nb_test
 
         maxevents = np.where(np.isnan(onlinac)==0)[0][-1]
         onlinac = onlinac[:maxevents]
@@ -790,11 +769,8 @@ def signumber(x,nb):
 
 def histoscore_lagorce(trainmap,testmap, verbose = True):
     
-    bhat_score = accuracy_lagorce(trainmap, testmap, 'bhatta')
-    norm_score = accuracy_lagorce(trainmap, testmap, 'norm')
-    eucl_score = accuracy_lagorce(trainmap, testmap, 'eucli')
-    KL_score = accuracy_lagorce(trainmap,testmap,'KL')
-    JS_score = accuracy_lagorce(trainmap,testmap,'JS')
+    scores = accuracies(trainmap, testmap, lagorce=True)
+    bhat_score, norm_score, eucl_score, KL_score, JS_score = [scores[measure] for measure in ['bhatta','norm','eucli','KL','JS']]
     if verbose:
         print(47*'-'+'SCORES'+47*'-')
         print(f'Classification scores with HOTS measures: bhatta = {np.round(bhat_score*100)}% - eucli = {np.round(eucl_score*100)}% - norm = {np.round(norm_score*100)}%')
@@ -804,11 +780,8 @@ def histoscore_lagorce(trainmap,testmap, verbose = True):
 
 def histoscore(trainmap,testmap, weights='distance',verbose = True):
     
-    bhat_score = accuracy(trainmap, testmap, 'bhatta')
-    norm_score = accuracy(trainmap, testmap, 'norm')
-    eucl_score = accuracy(trainmap, testmap, 'eucli')
-    KL_score = accuracy(trainmap,testmap,'KL')
-    JS_score = accuracy(trainmap,testmap,'JS')
+    scores = accuracies(trainmap, testmap)
+    bhat_score, norm_score, eucl_score, KL_score, JS_score = [scores[measure] for measure in ['bhatta','norm','eucli','KL','JS']]
     kNN_6 = knn(trainmap,testmap,6)
     kNN_3 = knn(trainmap,testmap,3)
     if verbose:
@@ -819,16 +792,16 @@ def histoscore(trainmap,testmap, weights='distance',verbose = True):
         print(100*'-')
     return bhat_score, norm_score, eucl_score, KL_score, JS_score, kNN_3, kNN_6
 
-def knn(trainmap,testmap,k, weights = 'uniform', metric = 'euclidean'):
+def knn(trainmap,testmap,k, weights = 'uniform', metric = 'euclidean', n_jobs = None):
     from sklearn.neighbors import KNeighborsClassifier
 
     X_train = np.array([trainmap[i][1]/np.sum(trainmap[i][1]) for i in range(len(trainmap))]).reshape(len(trainmap),len(trainmap[0][1]))
-    knn = KNeighborsClassifier(n_neighbors=k, weights=weights, metric = metric)
+    knn = KNeighborsClassifier(n_neighbors=k, weights=weights, metric = metric, n_jobs = n_jobs)
     knn.fit(X_train,[trainmap[i][0] for i in range(len(trainmap))])
-    accuracy = 0
-    for i in range(len(testmap)):
-        if knn.predict([testmap[i][1]/np.sum(testmap[i][1])])==testmap[i][0]:
-            accuracy += 1
+    # all the test histograms are classified in one call
+    X_test = np.array([testmap[i][1]/np.sum(testmap[i][1]) for i in range(len(testmap))]).reshape(len(testmap),len(testmap[0][1]))
+    labelz_hat = knn.predict(X_test)
+    accuracy = np.sum(labelz_hat==np.array([testmap[i][0] for i in range(len(testmap))]))
     return accuracy/len(testmap)
 
 def EuclidianNorm(hist1,hist2):
@@ -847,51 +820,48 @@ def JensenShannon(hist1, hist2):
     hist3 = (hist1+hist2)*0.5
     return (KullbackLeibler(hist1,hist3)+KullbackLeibler(hist2,hist3))*0.5
 
+def distances(histest, histrain, measure):
+    # distances between all the (normalized) test histograms of a chunk and all the train histograms, with the same
+    # operations as the functions above broadcasted over an array of shape (test, train, polarities)
+    histest, histrain = histest[:,None,:], histrain[None,:,:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if measure=='bhatta':
+            dist = -np.log(np.sum(np.sqrt(histest*histrain), axis=2))
+        elif measure=='eucli':
+            dist = np.sqrt(np.sum((histest-histrain)**2, axis=2))
+        elif measure=='norm':
+            dist = np.sqrt(np.sum((histest-histrain)**2, axis=2))/(np.linalg.norm(histest, axis=2)*np.linalg.norm(histrain, axis=2))
+        elif measure == 'KL':
+            dist = np.sum(histest*np.log(histest/histrain), axis=2)
+        elif measure == 'JS':
+            hist3 = (histest+histrain)*0.5
+            dist = (np.sum(histest*np.log(histest/hist3), axis=2)+np.sum(histrain*np.log(histrain/hist3), axis=2))*0.5
+    return dist
+
+def accuracies(trainmap, testmap, measures=['bhatta','norm','eucli','KL','JS'], lagorce=False, max_memory=2**28):
+    # accuracies of the nearest neighbour (nearest class histogram with lagorce=True) for all measures in one pass,
+    # the test histograms are processed by chunks so that the distance arrays stay below max_memory (in bytes)
+    if lagorce:
+        histrain = np.array(trainmap, dtype=float)
+        labeltrain = np.arange(len(histrain))
+    else:
+        histrain = np.array([trainmap[k][1] for k in range(len(trainmap))], dtype=float)
+        labeltrain = np.array([trainmap[k][0] for k in range(len(trainmap))])
+    histrain = histrain/np.sum(histrain, axis=1)[:,None]
+    histest = np.array([testmap[i][1] for i in range(len(testmap))], dtype=float)
+    histest = histest/np.sum(histest, axis=1)[:,None]
+    labeltest = np.array([testmap[i][0] for i in range(len(testmap))])
+
+    chunk = max(1, int(max_memory//(4*8*histrain.size)))
+    correct = dict((measure, 0) for measure in measures)
+    for start in range(0, len(histest), chunk):
+        for measure in measures:
+            dist = distances(histest[start:start+chunk], histrain, measure)
+            correct[measure] += np.sum(labeltrain[np.argmin(dist, axis=1)]==labeltest[start:start+chunk])
+    return dict((measure, correct[measure]/len(histest)) for measure in measures)
+
 def accuracy_lagorce(trainmap,testmap,measure):
-    accuracy=0
-    total = 0
-    for i in range(len(testmap)):
-        dist = np.zeros([trainmap.shape[0]])
-        histest = testmap[i][1]/np.sum(testmap[i][1])
-        for k in range(trainmap.shape[0]):
-            histrain = trainmap[k,:]/np.sum(trainmap[k,:])
-            if measure=='bhatta':
-                dist[k] = BattachaNorm(histest,histrain)
-            elif measure=='eucli':
-                dist[k] = EuclidianNorm(histest,histrain)
-            elif measure=='norm':
-                dist[k] = NormalizedNorm(histest,histrain)
-            elif measure == 'KL':
-                dist[k] = KullbackLeibler(histest,histrain)
-            elif measure == 'JS':
-                dist[k] = JensenShannon(histest,histrain)
-        if testmap[i][0]== np.argmin(dist):
-            accuracy+=1
-        total+=1
-    return accuracy/total
+    return accuracies(trainmap, testmap, [measure], lagorce=True)[measure]
 
 def accuracy(trainmap,testmap,measure):
-    accuracy=0
-    total = 0
-    #pbar = tqdm(total=int(len(testmap)))
-    for i in range(len(testmap)):
-        #pbar.update(1)
-        dist = np.zeros(len(trainmap))
-        histest = testmap[i][1]/np.sum(testmap[i][1])
-        for k in range(len(trainmap)):
-            histrain = trainmap[k][1]/np.sum(trainmap[k][1])
-            if measure=='bhatta':
-                dist[k] = BattachaNorm(histest,histrain)
-            elif measure=='eucli':
-                dist[k] = EuclidianNorm(histest,histrain)
-            elif measure=='norm':
-                dist[k] = NormalizedNorm(histest,histrain)
-            elif measure == 'KL':
-                dist[k] = KullbackLeibler(histest,histrain)
-            elif measure == 'JS':
-                dist[k] = JensenShannon(histest,histrain)
-        if testmap[i][0]==trainmap[np.argmin(dist)][0]:
-            accuracy+=1
-        total+=1
-    #pbar.close()
-    return accuracy/total
+    return accuracies(trainmap, testmap, [measure])[measure]
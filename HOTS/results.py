@@ -1,18 +1,20 @@
 from network import network
-from tools import fit_MLR, predict_MLR, score_classif_events, score_classif_time, get_loader, fit_histo, predict_histo
+from tools import fit_MLR, predict_MLR, score_classif_events, score_classif_time, get_loader, fit_histo, predict_histo, limit_threads
 import matplotlib.pyplot as plt
 import numpy as np
 from tqdm import tqdm
+import os, pickle, torch, multiprocessing, time
+from scipy.optimize import linear_sum_assignment
 
-def online_accuracy(network, tau_cla, trainset_raw, testset_raw, testset_tstpms, date, timestep, thres=None, width_fig = 20):
-
-    model, loss = fit_MLR(tau_cla, network = network, verbose = False)
-    likelihood, true_target, timestamps = predict_MLR(model, tau_cla, network = network, verbose = False)
+def online_accuracy(network, tau_cla, trainset_raw, testset_raw, testset_tstpms, date, timestep, thres=None, width_fig = 20, cached_features = True, max_cache_size = None):
+    # with cached_features, the features of the samples are computed once and read from the cache by the next runs
+    model, loss = fit_MLR(tau_cla, network = network, cached_features = cached_features, max_cache_size = max_cache_size, verbose = False)
+    likelihood, true_target, timestamps = predict_MLR(model, tau_cla, network = network, cached_features = cached_features, max_cache_size = max_cache_size, verbose = False)
     _, onlinac_ev, _, _, _ = score_classif_events(likelihood, true_target, verbose=False)
     _, onlinac_time, _, _, _ = score_classif_time(likelihood, true_target, timestamps, timestep, thres=thres, verbose=False)
     
-    model_raw, loss_raw = fit_MLR(tau_cla, date = date, dataset_as_input = trainset_raw, verbose = False)
-    likelihood_raw, true_target_raw, timestamps_raw = predict_MLR(model_raw, tau_cla, date = date, dataset_as_input = testset_raw, dataset_for_timestamps_as_input = testset_tstpms, verbose = False)
+    model_raw, loss_raw = fit_MLR(tau_cla, date = date, dataset_as_input = trainset_raw, cached_features = cached_features, max_cache_size = max_cache_size, verbose = False)
+    likelihood_raw, true_target_raw, timestamps_raw = predict_MLR(model_raw, tau_cla, date = date, dataset_as_input = testset_raw, dataset_for_timestamps_as_input = testset_tstpms, cached_features = cached_features, max_cache_size = max_cache_size, verbose = False)
     _, onlinac_ev_raw, _, _, _ = score_classif_events(likelihood_raw, true_target_raw, verbose=False)
     _, onlinac_time_raw, _, _, _ = score_classif_time(likelihood_raw, true_target_raw, timestamps_raw, timestep, thres=thres, verbose=False)
     
@@ -29,42 +31,46 @@ def online_accuracy(network, tau_cla, trainset_raw, testset_raw, testset_tstpms,
     axs[1].set_title('LR classification results evolution as a function of time');
     axs[1].legend()
     
-def clustering_variability(trainset, testset, homeo, tau, date, nb_trials=100):
+def clustering_variability(trainset, testset, homeo, tau, date, nb_trials=100, n_jobs=1, seed=0):
     
     nb_class = len(trainset.classes)
-    sensor_size = trainset.sensor_size
-    train_loader = get_loader(trainset)
-    test_loader = get_loader(testset)
-    acc = []
-    hom_acc = []
-    acc_3 = []
-    hom_acc_3 = []
-    acc_6 = []
-    hom_acc_6 = []
-    pbar = tqdm(total=nb_trials)
-    for trial in range(nb_trials):
-        timestr = date+f'_{trial}'
-        name = 'hots'
-        hots = network(name = name, tau = tau, homeo = homeo, timestr = timestr, camsize=(sensor_size[0], sensor_size[1]))
-        hots.running(train_loader, trainset.ordering, trainset.classes, learn=True, train=True, verbose=False)
-        hots.running(train_loader, trainset.ordering, trainset.classes, learn=False, train=True, verbose=False)
-        hots.running(test_loader, trainset.ordering, trainset.classes, learn=False, train=False, verbose=False)
-        histo, label = fit_histo(hots, verbose = False)
-        acc.append(predict_histo(hots, histo, label, k=1, verbose = False))
-        acc_3.append(predict_histo(hots, histo, label, k=3, verbose = False))
-        acc_6.append(predict_histo(hots, histo, label, k=6, verbose = False))
-        
-        name = 'homhots'
-        homhots = network(name = name, tau = tau, homeo = homeo, timestr = timestr, camsize=(sensor_size[0], sensor_size[1]))
-        homhots.running(train_loader, trainset.ordering, trainset.classes, learn=True, train=True, verbose=False)
-        homhots.running(train_loader, trainset.ordering, trainset.classes, learn=False, train=True, verbose=False)
-        homhots.running(test_loader, trainset.ordering, trainset.classes, learn=False, train=False, verbose=False)
-        histo, label = fit_histo(homhots, verbose = False)
-        hom_acc.append(predict_histo(homhots, histo, label, k=1, verbose = False))
-        hom_acc_3.append(predict_histo(homhots, histo, label, k=3, verbose = False))
-        hom_acc_6.append(predict_histo(homhots, histo, label, k=6, verbose = False))
-        pbar.update(1)
+    # the trials run on a pool of processes sharing the datasets, each finished trial is saved so that an interrupted
+    # run starts again from the trials left. The trials (and their networks) are identified by the date, the seed and
+    # the datasets, a run with another seed or other datasets does not reuse them
+    key = f'{date}_{seed}_{type(trainset).__name__}_{len(trainset)}_{len(testset)}'
+    path = f'../Records/results/{key}_{tau}_{homeo}_clustering_variability/'
+    os.makedirs(path, exist_ok=True)
+    trials = [trial for trial in range(nb_trials) if not os.path.isfile(path+f'{trial}.pkl')]
+    pbar = tqdm(total=nb_trials, initial=nb_trials-len(trials))
+    if n_jobs>1:
+        pool = multiprocessing.Pool(n_jobs, initializer=init_trial, initargs=(trainset, testset, homeo, tau, key, seed, 1, True))
+        outputs = pool.imap_unordered(run_trial, trials)
+    else:
+        init_trial(trainset, testset, homeo, tau, key, seed)
+        pool, outputs = None, map(run_trial, trials)
+    try:
+        for trial, scores in outputs:
+            # the checkpoint is written aside and renamed, an interruption never leaves a truncated trial file
+            with open(path+f'{trial}.pkl.tmp', 'wb') as file:
+                pickle.dump(scores, file, pickle.HIGHEST_PROTOCOL)
+            os.replace(path+f'{trial}.pkl.tmp', path+f'{trial}.pkl')
+            pbar.update(1)
+    except BaseException:
+        if pool:
+            pool.terminate()
+            pool.join()
+        pbar.close()
+        raise
+    if pool:
+        pool.close()
+        pool.join()
     pbar.close()
+
+    scores = []
+    for trial in range(nb_trials):
+        with open(path+f'{trial}.pkl', 'rb') as file:
+            scores.append(pickle.load(file))
+    acc, acc_3, acc_6, hom_acc, hom_acc_3, hom_acc_6 = np.array(scores).T
         
 
     labels = ['original HOTS', 'HOTS with homeostasis']
@@ -103,3 +109,138 @@ def clustering_variability(trainset, testset, homeo, tau, date, nb_trials=100):
 
     plt.show()
 
+def batch_learning(trainset, name, homeo, tau, date, batch_sizes=(64, 256, 1024), seed=0, width_fig=20):
+    # compares the kernels learned with mini-batches (learn_batch) to the ones of sequential learning from the same
+    # initialization and the same order of the samples: each kernel is matched to a sequential kernel of its layer
+    # (maximal total cosine similarity) and the mean similarity of the matched kernels is reported with the learning time
+    sensor_size = trainset.sensor_size
+    loader = get_loader(trainset, shuffle=False)
+    kernels, times = {}, {}
+    for learn_batch in (None,)+tuple(batch_sizes):
+        np.random.seed(seed)
+        hots = network(name = name, tau = tau, homeo = homeo, timestr = date, camsize=(sensor_size[0], sensor_size[1]), learn_batch = learn_batch)
+        start = time.time()
+        for events, target in tqdm(loader, desc=f'mini-batch {learn_batch}'):
+            for _ in hots.stream(events.squeeze(), trainset.ordering, learn=True):
+                pass
+        times[learn_batch] = time.time()-start
+        kernels[learn_batch] = [L.kernel for L in hots.L]
+
+    similarity = {}
+    for learn_batch in batch_sizes:
+        similarity[learn_batch] = []
+        for kernel, kernel_seq in zip(kernels[learn_batch], kernels[None]):
+            simil = np.dot(kernel.T, kernel_seq)/np.outer(np.linalg.norm(kernel, axis=0), np.linalg.norm(kernel_seq, axis=0))
+            row, col = linear_sum_assignment(-simil)
+            similarity[learn_batch].append(simil[row, col].mean())
+        print(f'mini-batch {learn_batch}: learning time {times[learn_batch]:.1f}s (sequential {times[None]:.1f}s) - similarity of the kernels per layer {np.round(similarity[learn_batch], 3)}')
+
+    fig, axs = plt.subplots(1,2, figsize=(width_fig,width_fig/3))
+    for learn_batch in batch_sizes:
+        axs[0].plot(np.arange(len(kernels[None]))+1, similarity[learn_batch], 'o-', label=f'mini-batch {learn_batch}')
+    axs[0].set_xlabel('layer');
+    axs[0].set_ylabel('cosine similarity with the sequential kernels');
+    axs[0].legend()
+    axs[1].bar(['sequential']+[str(learn_batch) for learn_batch in batch_sizes], [times[learn_batch] for learn_batch in (None,)+tuple(batch_sizes)])
+    axs[1].set_ylabel('learning time (in s)');
+    plt.show()
+    return similarity, times
+
+def precision_check(trainset, testset, name, homeo, tau, date, dtype=np.float32, tolerance=1e-3, seed=0):
+    # tolerance check of a network running with a reduced precision (dtype) against float64:
+    # - inference: the kernels learned in float64 are rounded to dtype and the output events (x, y, t, cluster) of the
+    #   test samples are compared, the fraction of events that differ must stay below tolerance
+    # - learning: the relative difference of the kernels learned in dtype and in float64 from the same initialization
+    #   is reported (a rounding that changes the closest prototype of one event makes the learnings drift apart, this
+    #   difference measures the drift and is not checked against the tolerance)
+    sensor_size = trainset.sensor_size
+    nets = []
+    for precision in [np.float64, dtype]:
+        np.random.seed(seed)
+        hots = network(name = name, tau = tau, homeo = homeo, timestr = date, camsize=(sensor_size[0], sensor_size[1]), dtype = precision)
+        for events, target in tqdm(get_loader(trainset, shuffle=False), desc=f'learning in {np.dtype(precision).name}'):
+            for _ in hots.stream(events.squeeze(), trainset.ordering, learn=True):
+                pass
+        nets.append(hots)
+    reference, reduced = nets
+    kernel_error = [np.linalg.norm(L.kernel-L_ref.kernel)/np.linalg.norm(L_ref.kernel) for L, L_ref in zip(reduced.L, reference.L)]
+
+    for L, L_ref in zip(reduced.L, reference.L):
+        L.kernel = L_ref.kernel.astype(dtype)
+        L.setnorm()
+    nb_diff, nb_events = 0, 0
+    for events, target in tqdm(get_loader(testset, shuffle=False), desc='inference'):
+        outputs = []
+        for hots in [reference, reduced]:
+            events_output = list(hots.stream(events.squeeze(), testset.ordering))
+            outputs.append(set(map(tuple, np.concatenate(events_output).tolist())) if events_output else set())
+        nb_diff += len(outputs[0]^outputs[1])
+        nb_events += max(len(outputs[0]), len(outputs[1]))
+    mismatch = nb_diff/max(nb_events, 1)
+
+    print(f'relative difference of the kernels learned in {np.dtype(dtype).name} per layer: {np.array2string(np.array(kernel_error), precision=1)}')
+    print(f'fraction of the output events that differ in inference: {mismatch:.2e} (tolerance {tolerance:.0e})')
+    return mismatch<=tolerance, mismatch, kernel_error
+
+def backend_check(trainset, testset, name, homeo, tau, date, tolerance=1e-12, seed=0):
+    # check of the compiled loop (backend='numba') against the numpy backend: both networks learn from the same
+    # initialization and the same order of the samples, the largest difference of their kernels must stay below
+    # tolerance (the order of the floating point operations differs) and the output events (x, y, t, cluster) of
+    # the test samples must be the same. The time of learning and inference of each backend is reported
+    sensor_size = trainset.sensor_size
+    nets, outputs, times = {}, {}, {}
+    for backend in ['numpy', 'numba']:
+        np.random.seed(seed)
+        hots = network(name = name, tau = tau, homeo = homeo, timestr = date, camsize=(sensor_size[0], sensor_size[1]), backend = backend)
+        if hots.backend != backend:
+            return False, np.nan, np.nan
+        start = time.time()
+        for events, target in tqdm(get_loader(trainset, shuffle=False), desc=f'learning with {backend}'):
+            for _ in hots.stream(events.squeeze(), trainset.ordering, learn=True):
+                pass
+        learning = time.time()-start
+        start = time.time()
+        outputs[backend] = []
+        for events, target in tqdm(get_loader(testset, shuffle=False), desc=f'inference with {backend}'):
+            events_output = list(hots.stream(events.squeeze(), testset.ordering))
+            outputs[backend].append(np.concatenate(events_output) if events_output else np.zeros([0,4], dtype=np.int64))
+        times[backend] = (learning, time.time()-start)
+        nets[backend] = hots
+    kernel_error = max(np.abs(L.kernel-L_ref.kernel).max() for L, L_ref in zip(nets['numba'].L, nets['numpy'].L))
+    nb_diff = sum(not np.array_equal(output, output_ref) for output, output_ref in zip(outputs['numba'], outputs['numpy']))
+
+    for backend in ['numpy', 'numba']:
+        print(f'{backend}: learning {times[backend][0]:.1f}s - inference {times[backend][1]:.1f}s')
+    print(f'largest difference of the kernels: {kernel_error:.1e} (tolerance {tolerance:.0e})')
+    print(f'test samples with different output events: {nb_diff}/{len(outputs["numpy"])}')
+    return kernel_error<=tolerance and nb_diff==0, kernel_error, nb_diff
+
+trial_parameters = None
+
+def init_trial(trainset, testset, homeo, tau, key, seed, n_jobs=16, single_thread=False):
+    # the datasets and parameters are given once to each process running trials (n_jobs of the kNN, 1 in a pool)
+    global trial_parameters
+    if single_thread:
+        limit_threads()
+    trial_parameters = (trainset, testset, homeo, tau, key, seed, n_jobs)
+
+def run_trial(trial):
+    # trains and evaluates the hots and homhots networks for one trial, with its own seed
+    trainset, testset, homeo, tau, key, seed, n_jobs = trial_parameters
+    np.random.seed(seed+trial)
+    torch.manual_seed(seed+trial)
+    sensor_size = trainset.sensor_size
+    train_loader = get_loader(trainset)
+    test_loader = get_loader(testset)
+    timestr = key+f'_{trial}'
+    scores = []
+    for name in ['hots', 'homhots']:
+        hots = network(name = name, tau = tau, homeo = homeo, timestr = timestr, camsize=(sensor_size[0], sensor_size[1]))
+        hots.running(train_loader, trainset.ordering, trainset.classes, learn=True, train=True, verbose=False)
+        hots.running(train_loader, trainset.ordering, trainset.classes, learn=False, train=True, verbose=False)
+        hots.running(test_loader, trainset.ordering, trainset.classes, learn=False, train=False, verbose=False)
+        histo, label = fit_histo(hots, verbose = False)
+        for k in [1, 3, 6]:
+            scores.append(predict_histo(hots, histo, label, k=k, n_jobs=n_jobs, verbose = False))
+    return trial, scores
+
@@ -3,22 +3,22 @@ import numpy as np
 class stats(object):
     """ """
 
-    def __init__(self, N, camsize):
+    def __init__(self, N, camsize, dtype=np.float64):
         self.nbqt = 1000
         self.count = 0
         self.dist_cum = 0
         self.dist = []
-        self.actmap = np.zeros([N,camsize[0]+1,camsize[1]+1])
-        self.delta_wt = np.zeros([4])
+        self.actmap = np.zeros([N,camsize[0]+1,camsize[1]+1], dtype=dtype)
+        self.delta_wt = np.zeros([4], dtype=dtype)
 
-    def update(self, p, dic, X, tau, dic_prev):
+    def update(self, p, dic, X, tau, krnl_prev):
         dist = np.linalg.norm(X - dic[:,p])
         self.dist_cum += dist
         dt = -tau*np.log(X)
         dt_krnl = -tau*np.log(dic[:,p])
-        dw = dic[:,p]-dic_prev[:,p]
+        dw = dic[:,p]-krnl_prev
 
-        self.delta_wt = np.vstack((self.delta_wt, np.array([dw,dt,dt_krnl, dic_prev[:,p]]).T))
+        self.delta_wt = np.vstack((self.delta_wt, np.array([dw,dt,dt_krnl, krnl_prev]).T))
 
         self.count += 1
         if self.count==self.nbqt:
@@ -1,6 +1,7 @@
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import axes3d
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
 class timesurface(object):
     """ TimeSurface is a class created from a stream of events. It stores the events on the pixel grid and apply an exponential decay to past events when updating the time surface. It returns the timesurface defined by a spatial window. The output is a 1D vector representing the time-surface.
@@ -15,6 +16,13 @@ class timesurface(object):
             dtemp -> minimum time required between 2 events on the same pixel to avoid camera issues
                                         (some pixels (x>255) spike 2 times)
             kthrs -> constante*tau defining a null threshold for past events
+            storage -> 'grid' stores the decayed values of the whole pixel grid and updates them at each event,
+                        'timestamp' stores the timestamp of the last event of each pixel and computes the decay
+                        only within the spatial window when a time surface is requested
+            tmat -> the matrix of the last timestamps of the whole pixel grid (with storage='timestamp')
+            dtype -> the precision of the decayed values of the pixel grid and of the time surfaces
+            mask -> the gaussian spatial mask applied to the time surface when sigma is given (cached with the
+                        (sigma, window shape) it was computed for in maskkey)
 
     METHODS:
             .addevent -> add an event to the time surface when event.x, event.y, event.t and p is given as input
@@ -22,10 +30,18 @@ class timesurface(object):
                         output: time surface, activ (bolean indicating if the number of non zero pixels in the time surface is above a threshold)
             .plote -> plot the timesurface TimeSurface.timesurf
                 parameters: timesurf, gamma to display events (2.2 default)
+            .batch_surfaces -> adds a whole array of events at once (structured array with fields x, y, t, p)
+                        output: matrix of the flattened time surfaces of all events (float32 by default), activity mask of the events
             .getts -> take the time surface within the spatial window defined by R on the matrix spatpmat
+            .getwindow -> returns the spatial window around the last event (symmetric padding near the edges)
+            .getmask -> returns the gaussian spatial mask for a given window shape (computed once and cached)
+            .getspatpmat -> returns the decayed values of the whole pixel grid
+            .decayfunc -> applies the decay to an array of time differences
+            .allocate -> allocates the state of the pixel grid for a given shape
+            .reset -> sets the state of the time surface to its initial value
 """
 
-    def __init__(self, R, tau, camsize, nbpol, sigma, decay):
+    def __init__(self, R, tau, camsize, nbpol, sigma, decay, storage='grid', dtype=np.float64):
         # PARAMETERS OF THE TIME SURFACE
         self.R = R
         self.tau = tau # in micro secondes
@@ -34,31 +50,87 @@ class timesurface(object):
         self.filt = .3
         self.sigma = sigma
         self.decay = decay
+        self.storage = storage
+        self.dtype = dtype # precision of the decayed values (pixel grid and time surfaces)
+        self.mask, self.maskkey = None, None
+        # timestamp given to pixels that never received an event (far enough in the past to be fully decayed)
+        self.tvoid = np.iinfo(np.int64).min//2
         # VARIABLES OF THE TIME SURFACE
+        self.allocate([nbpol,camsize[0],camsize[1]])
+        self.reset()
+
+    def __setstate__(self, state):
+        # time surfaces saved before the storage option was introduced store the whole pixel grid
+        state.setdefault('storage', 'grid')
+        state.setdefault('tvoid', np.iinfo(np.int64).min//2)
+        state.setdefault('mask', None)
+        state.setdefault('maskkey', None)
+        state.setdefault('dtype', np.float64)
+        self.__dict__.update(state)
+        if not hasattr(self, 'xcell'):
+            self.setindex(self.tmat.shape if self.storage == 'timestamp' else self.spatpmat.shape)
+
+    def allocate(self, shape):
+        self.setindex(shape)
+        # the window shape may have changed (e.g. network.sensformat), the mask is computed again on the next event
+        self.mask, self.maskkey = None, None
+        if self.storage == 'timestamp':
+            self.tmat = np.full(shape, self.tvoid, dtype=np.int64)
+        else:
+            self.spatpmat = np.zeros(shape, dtype=self.dtype)
+
+    def reset(self):
         self.x = 0
         self.y = 0
         self.t = 0
         self.p = 0
         self.iev = 0
-        self.spatpmat = np.zeros([nbpol,camsize[0],camsize[1]])
+        if self.storage == 'timestamp':
+            self.tmat[:] = self.tvoid
+        else:
+            self.spatpmat[:] = 0
+
+    def decayfunc(self, dt):
+        if self.decay == 'exponential':
+            # dt/(-tau) is the same value as -dt/tau with one temporary array less, the exponential is taken in place
+            # after clipping the old events (the underflow of exp is slow, they are set to 0 by the threshold anyway)
+            surf = dt/(-self.tau)
+            np.maximum(surf, -self.kthrs-1, out=surf)
+            np.exp(surf, out=surf)
+            # making threshold for small elements
+            surf[surf<np.exp(-self.kthrs)]=0
+        elif self.decay == 'linear':
+            surf = np.maximum(1-dt/self.tau,0)
+        return surf.astype(self.dtype, copy=False)
+
+    def getspatpmat(self):
+        if self.storage == 'timestamp':
+            return self.decayfunc(self.t-self.tmat)
+        else:
+            return self.spatpmat.copy()
 
     def addevent(self, xev, yev, tev, pev): # get integers as input
         TS = []
         self.iev += 1
         self.x, self.y, self.p = xev, yev, pev
         # updating the spatiotemporal surface
-        if self.decay == 'exponential':
-            self.spatpmat = self.spatpmat*np.exp(-(tev-self.t)/self.tau)
-            # making threshold for small elements
-            self.spatpmat[self.spatpmat<np.exp(-self.kthrs)]=0
-        elif self.decay == 'linear':
-            self.spatpmat = max(self.spatpmat-(tev-self.t)/self.tau,0)
+        if self.storage == 'timestamp':
+            # only the timestamp of the new event is stored, the decay is computed in getts
+            self.tmat[self.p, self.x, self.y] = tev
+        else:
+            if self.decay == 'exponential':
+                # in place to keep the precision of the grid
+                self.spatpmat *= np.exp(-(tev-self.t)/self.tau)
+                # making threshold for small elements
+                self.spatpmat[self.spatpmat<np.exp(-self.kthrs)]=0
+            elif self.decay == 'linear':
+                self.spatpmat = max(self.spatpmat-(tev-self.t)/self.tau,0)
+            self.spatpmat[self.p, self.x, self.y] = 1
         self.t = tev
-        self.spatpmat[self.p, self.x, self.y] = 1
         if self.R:
             timesurf = self.getts()
         else:
-            timesurf = self.spatpmat.copy()
+            timesurf = self.getspatpmat()
 
         if self.sigma is not None:
             timesurf = self.apply_mask(timesurf)
@@ -68,45 +140,131 @@ class timesurface(object):
             TS = np.reshape(timesurf, [timesurf.shape[0]*timesurf.shape[1]*timesurf.shape[2]])
         return TS
 
+    def batch_surfaces(self, events, chunksize=64, dtype=np.float32):
+        # vectorized version of addevent for storage='timestamp': the time surfaces and activity mask are the same as
+        # the ones of successive calls of addevent on the events sorted by time, and the state is updated the same way
+        assert self.storage == 'timestamp', "batch_surfaces needs a time surface with storage='timestamp'"
+        events = events[np.argsort(events['t'], kind='stable')]
+        x, y, t, p = [events[name].astype(np.int64) for name in ['x','y','t','p']]
+        nbev = len(events)
+        nbpol, width, height = self.tmat.shape
+        sx, sy = (2*self.R+1,)*2 if self.R else (width, height)
+        TS, activ = [], []
+        for start in range(0, nbev, chunksize):
+            xc, yc, tc, pc = x[start:start+chunksize], y[start:start+chunksize], t[start:start+chunksize], p[start:start+chunksize]
+            n = len(xc)
+            # the windows are read once in the timestamps of the beginning of the chunk
+            if self.R:
+                padded = self.tmat[:,self.xindex][:,:,self.yindex]
+                windows = sliding_window_view(padded, (sx,sy), axis=(1,2)).transpose(1,2,0,3,4)
+                tlast = np.ascontiguousarray(windows[xc,yc])
+            else:
+                tlast = np.repeat(self.tmat[None], n, axis=0)
+            # then patched with the events of the chunk that fall in the window of the same or a later event: cx and cy
+            # give the cells of a window where a pixel is read (several cells near the edges, -1 outside of the window)
+            j, k = np.nonzero(np.tri(n, dtype=bool))
+            cx, cy = self.xcell[xc[j],xc[k]], self.ycell[yc[j],yc[k]]
+            near = (cx[:,0]>=0)&(cy[:,0]>=0)
+            j, k, cx, cy = j[near], k[near], cx[near], cy[near]
+            valid = (cx[:,:,None]>=0)&(cy[:,None,:]>=0)
+            cell = ((j*nbpol+pc[k])[:,None,None]*sx+cx[:,:,None])*sy+cy[:,None,:]
+            cell, k = cell[valid], np.broadcast_to(k[:,None,None], valid.shape)[valid]
+            # the last event of the chunk at the pixel of a cell gives its timestamp
+            order = np.lexsort((k, cell))
+            cell, k = cell[order], k[order]
+            last = np.append(cell[1:]!=cell[:-1], True)
+            tlast.reshape(-1)[cell[last]] = tc[k[last]]
+
+            timesurf = self.decayfunc(tc[:,None,None,None]-tlast)
+            if self.sigma is not None:
+                timesurf *= self.getmask(timesurf.shape[2:])
+            card = np.count_nonzero(timesurf[np.arange(n),pc], axis=(1,2))
+            activ.append(card>self.filt*timesurf.shape[2]*timesurf.shape[3]/timesurf.shape[1])
+            TS.append(timesurf.reshape(n,-1).astype(dtype, copy=False))
+
+            # the last event of each pixel gives the new state of the time surface
+            pix = (pc*width+xc)*height+yc
+            _, first = np.unique(pix[::-1], return_index=True)
+            self.tmat.reshape(-1)[pix[n-1-first]] = tc[n-1-first]
+
+        if nbev:
+            self.x, self.y, self.t, self.p = int(x[-1]), int(y[-1]), int(t[-1]), int(p[-1])
+            self.iev += nbev
+            TS, activ = np.concatenate(TS), np.concatenate(activ)
+        else:
+            TS = np.zeros([0, nbpol*sx*sy], dtype=dtype)
+            activ = np.zeros([0], dtype=bool)
+        return TS, activ
+
     def getts(self):
-        xshift = self.x
-        yshift = self.y
-        # padding for events near the edges of the pixel grid
-        temp_spatpmat = self.spatpmat.copy()
-        if self.x-self.R<0:
-            temp_spatpmat = np.lib.pad(temp_spatpmat,((0,0),(self.R,0),(0,0)),'symmetric')
-            xshift += self.R
-        if self.camsize[0]<=self.x+self.R:
-            temp_spatpmat = np.lib.pad(temp_spatpmat,((0,0),(0,self.R),(0,0)),'symmetric')
-        if self.y-self.R<0:
-            temp_spatpmat = np.lib.pad(temp_spatpmat,((0,0),(0,0),(self.R,0)),'symmetric')
-            yshift += self.R
-        if self.camsize[1]<=self.y+self.R:
-            temp_spatpmat = np.lib.pad(temp_spatpmat,((0,0),(0,0),(0,self.R+1)),'symmetric')
-        timesurf = temp_spatpmat[:,int(xshift-self.R):int(xshift+self.R)+1,int(yshift-self.R):int(yshift+self.R)+1]
-        return timesurf
+        if self.storage == 'timestamp':
+            return self.decayfunc(self.t-self.getwindow(self.tmat))
+        else:
+            return self.getwindow(self.spatpmat).copy()
+
+    def getwindow(self, state):
+        # events near the edges of the pixel grid read a symmetric padding of the grid through the index tables
+        if self.R<=self.x<state.shape[1]-self.R and self.R<=self.y<state.shape[2]-self.R:
+            return state[:,self.x-self.R:self.x+self.R+1,self.y-self.R:self.y+self.R+1]
+        xindex = self.xindex[self.x:self.x+2*self.R+1]
+        yindex = self.yindex[self.y:self.y+2*self.R+1]
+        return state[:,xindex[:,None],yindex[None,:]]
+
+    def setindex(self, shape):
+        # index tables of the pixel grid padded with R pixels on each side (same as a 'symmetric' np.pad)
+        R = self.R or 0
+        index, cell = [], []
+        for size in shape[1:]:
+            ind = np.arange(-R,size+R)%(2*size)
+            ind[ind>=size] = 2*size-1-ind[ind>=size]
+            index.append(ind)
+            # cells of the window around each pixel where each pixel of the grid is read (-1 if it is not in the window)
+            if self.R:
+                window = ind[np.arange(size)[:,None]+np.arange(2*R+1)]
+            else:
+                window = np.broadcast_to(np.arange(size), (size, size))
+            rows = np.arange(size)
+            count = np.zeros([size, size], dtype=int)
+            for d in range(window.shape[1]):
+                count[rows,window[:,d]] += 1
+            table = np.full([size, size, count.max()], -1)
+            count[:] = 0
+            for d in range(window.shape[1]):
+                table[rows,window[:,d],count[rows,window[:,d]]] = d
+                count[rows,window[:,d]] += 1
+            cell.append(table)
+        self.xindex, self.yindex = index
+        self.xcell, self.ycell = cell
     
     def apply_mask(self, timesurf):
-        X_p, Y_p = np.meshgrid(np.arange(-timesurf.shape[1]//2, timesurf.shape[1]//2),
-                                     np.arange(-timesurf.shape[2]//2, timesurf.shape[2]//2))
-        radius = np.sqrt(X_p**2 + Y_p**2)
-        mask_circular = np.exp(- .5 * radius**2 / self.sigma**2)/(2*np.pi*self.sigma)
-        timesurf *= mask_circular
+        # the mask broadcasts over the polarities and is applied in place
+        timesurf *= self.getmask(timesurf.shape[1:])
         return timesurf
 
+    def getmask(self, shape):
+        key = (self.sigma, tuple(shape))
+        if self.maskkey != key:
+            X_p, Y_p = np.meshgrid(np.arange(-shape[0]//2, shape[0]//2),
+                                         np.arange(-shape[1]//2, shape[1]//2))
+            radius = np.sqrt(X_p**2 + Y_p**2)
+            self.mask = np.exp(- .5 * radius**2 / self.sigma**2)/(2*np.pi*self.sigma)
+            self.maskkey = key
+        return self.mask
+
     def plote(self, gamma=1):
 
+        spatpmat = self.getspatpmat()
         if self.R:
             timesurf = self.getts()
         else:
-            timesurf = self.spatpmat.copy()
+            timesurf = spatpmat.copy()
             
         if self.sigma is not None:
             timesurf = self.apply_mask(timesurf)
 
         fig = plt.figure(figsize=(10,5))
         sub1 = fig.add_subplot(1,3,1)
-        mapa = sub1.imshow((self.spatpmat[self.p].T)**gamma, cmap=plt.cm.plasma)
+        mapa = sub1.imshow((spatpmat[self.p].T)**gamma, cmap=plt.cm.plasma)
         sub1.plot(self.x,self.y,'r*')
         if self.R:
             sub1.plot([self.x-self.R, self.x-self.R], [self.y-self.R, self.y+self.R], color='red')
@@ -1,6 +1,7 @@
 from HOTS.network import network
 import numpy as np
-import os, torch, tonic, pickle
+import os, torch, tonic, pickle, hashlib, multiprocessing
+from collections import OrderedDict
 from tqdm import tqdm
 import matplotlib.pyplot as plt
 from sklearn.neighbors import KNeighborsClassifier
@@ -124,12 +125,15 @@ def get_dataset_info(trainset, testset, properties = ['mean_isi', 'synchronous_e
     return values
 
 class HOTS_Dataset(tonic.dataset.Dataset):
-    """Make a dataset from the output of the HOTS network
+    """Make a dataset from the output of the HOTS network (one .npy file per sample, or the consolidated output
+    of network.running where the samples are sliced by offsets in one memory-mapped array of events).
+    With lazy=True only the paths of the files are recorded and the samples are loaded in __getitem__, the last
+    cache_size decoded samples being kept in memory.
     """
     dtype = np.dtype([("x", int), ("y", int), ("t", int), ("p", int)])
     ordering = dtype.names
 
-    def __init__(self, path_to, sensor_size, train=True, transform=None, target_transform=None):
+    def __init__(self, path_to, sensor_size, train=True, transform=None, target_transform=None, lazy=False, cache_size=0):
         super(HOTS_Dataset, self).__init__(
             path_to, transform=transform, target_transform=target_transform
         )
@@ -141,16 +145,33 @@ class HOTS_Dataset(tonic.dataset.Dataset):
             return
 
         self.sensor_size = sensor_size
-        
+        self.lazy = lazy
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.offsets = None
+        # the memory-mapped events are opened at the first access (in each worker of the loader)
+        self.events = None
+
+        if os.path.isfile(os.path.join(self.location_on_system, 'events.dat')):
+            self.offsets = np.load(os.path.join(self.location_on_system, 'offsets.npy'))
+            self.targets = np.load(os.path.join(self.location_on_system, 'targets.npy')).tolist()
+            self.classes = np.load(os.path.join(self.location_on_system, 'classes.npy')).tolist()
+            self.int_classes = dict(zip(self.classes, range(len(self.classes))))
+            return
+
         for path, dirs, files in os.walk(self.location_on_system):
             files.sort()
+            dirs.sort()
             if dirs:
                 label_length = len(dirs[0])
                 self.classes = dirs
                 self.int_classes = dict(zip(self.classes, range(len(dirs))))
             for file in files:
                 if file.endswith("npy"):
-                    self.data.append(np.load(os.path.join(path, file)))
+                    if self.lazy:
+                        self.data.append(os.path.join(path, file))
+                    else:
+                        self.data.append(np.load(os.path.join(path, file)))
                     self.targets.append(self.int_classes[path[-label_length:]])
 
     def __getitem__(self, index):
@@ -158,7 +179,7 @@ class HOTS_Dataset(tonic.dataset.Dataset):
         Returns:
             a tuple of (events, target) where target is the index of the target class.
         """
-        events, target = self.data[index], self.targets[index]
+        events, target = self.load(index), self.targets[index]
         events = np.lib.recfunctions.unstructured_to_structured(events, self.dtype)
         if self.transform is not None:
             events = self.transform(events)
@@ -166,8 +187,37 @@ class HOTS_Dataset(tonic.dataset.Dataset):
             target = self.target_transform(target)
         return events, target
 
+    def load(self, index):
+        if index in self.cache:
+            self.cache.move_to_end(index)
+            return self.cache[index]
+        if self.offsets is not None:
+            events = np.array(self.get_events()[self.offsets[index]:self.offsets[index+1]])
+        elif self.lazy:
+            events = np.array(np.load(self.data[index], mmap_mode='r'))
+        else:
+            return self.data[index]
+        if self.cache_size:
+            self.cache[index] = events
+            if len(self.cache)>self.cache_size:
+                self.cache.popitem(last=False)
+        return events
+
+    def get_events(self):
+        # memory-mapped events of all the samples of the consolidated output
+        if self.events is None:
+            self.events = np.memmap(os.path.join(self.location_on_system, 'events.dat'), dtype=np.int64, mode='r').reshape(-1,4)
+        return self.events
+
+    def __getstate__(self):
+        # the memory-mapped events and the cache are not sent to the workers of the loader
+        state = self.__dict__.copy()
+        state['events'] = None
+        state['cache'] = OrderedDict()
+        return state
+
     def __len__(self):
-        return len(self.data)
+        return len(self.targets)
 
     def _check_exists(self):
         return self._is_file_present() and self._folder_contains_at_least_n_files_of_type(
@@ -188,12 +238,28 @@ def fit_MLR(tau_cla, #enter tau_cla in ms
             betas = (0.9, 0.999),
             num_epochs = 2 ** 5 + 1,
             seed = 42,
+            batch_size = None, # if given, the features are computed once and the model is trained with mini-batches of events
+            dtype = None, # precision of the model (the one of the network, float64 without network, if None)
+            sparse = False, # sparse features (values below epsilon are set to zero)
+            epsilon = 0,
+            max_cache_size = None, # size (in bytes) above which the least recently used cached features are removed
+            cached_features = False, # the features are computed once and kept in the cache (they are read from the
+                                     # cache whenever it holds them, even without this option)
             verbose=True):
     
+    if dtype is None:
+        dtype = torch.from_numpy(np.zeros(0, dtype=network.dtype)).dtype if network else torch.float64
     if network:
-        model_name = f'../Records/models/{network.get_fname()}_{int(tau_cla)}_{kfold}_LR.pkl'
+        f_name = f'{network.get_fname()}_{int(tau_cla)}_{kfold}'
     else:
-        model_name = f'../Records/models/{date}_raw_{int(tau_cla)}_{kfold}_LR.pkl'
+        f_name = f'{date}_raw_{int(tau_cla)}_{kfold}'
+    if batch_size:
+        f_name += f'_{batch_size}_{str(dtype)[6:]}'
+    elif dtype != torch.float64:
+        f_name += f'_{str(dtype)[6:]}'
+    if sparse:
+        f_name += f'_sparse_{epsilon}'
+    model_name = f'../Records/models/{f_name}_LR.pkl'
     if verbose: print(f'Name of the model: \n {model_name}')
         
     if os.path.isfile(model_name):
@@ -201,44 +267,80 @@ def fit_MLR(tau_cla, #enter tau_cla in ms
             logistic_model, losses = pickle.load(file)
     else:
         tau_cla*=1e3
+        # the features do not depend on the size of the mini-batches, the sequential learning reads them from the
+        # cache instead of computing the time surfaces of the samples again at each epoch
+        np_dtype = torch.empty(0, dtype=dtype).numpy().dtype
+        features_name = get_features_name(tau_cla, 'train', network=network, date=date, kfold=kfold, kfold_ind=kfold_ind, seed=seed, dtype=np_dtype, sparse=sparse, epsilon=epsilon)
+        hit = os.path.isfile(features_name+'_labels.npy')
+        cached = batch_size or cached_features or hit
         if network:
             path_to_dataset = f'../Records/output/train/{network.get_fname()}_None/'
             timesurface_size = (network.TS[0].camsize[0], network.TS[0].camsize[1], network.L[-1].kernel.shape[1])
-            transform = tonic.transforms.Compose([tonic.transforms.ToTimesurface(sensor_size=timesurface_size, tau=tau_cla, decay="exp")])
-            dataset = HOTS_Dataset(path_to_dataset, timesurface_size, transform=transform)
+            if hit and os.path.isfile(features_name+'_classes.npy'):
+                # the events of the samples are not read when their features are in the cache
+                dataset, classes = None, np.load(features_name+'_classes.npy').tolist()
+            else:
+                transform = tonic.transforms.Compose([tonic.transforms.ToTimesurface(sensor_size=timesurface_size, tau=tau_cla, decay="exp")])
+                dataset = HOTS_Dataset(path_to_dataset, timesurface_size, transform=transform, lazy=True)
+                classes = dataset.classes
         else:
             dataset = dataset_as_input 
             timesurface_size = dataset.sensor_size
-        loader = get_loader(dataset, kfold = kfold, kfold_ind = kfold_ind, num_workers = num_workers, seed=seed)
+            classes = dataset.classes
+        loader = get_loader(dataset, kfold = kfold, kfold_ind = kfold_ind, num_workers = num_workers, seed=seed) if dataset is not None else None
 
-        torch.set_default_tensor_type("torch.DoubleTensor")
         criterion = torch.nn.BCELoss(reduction="mean")
         amsgrad = True #or False gives similar results
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         if verbose: print(f'device -> {device} - num workers -> {num_workers}')
 
         N = timesurface_size[0]*timesurface_size[1]*timesurface_size[2]
-        n_classes = len(dataset.classes)
-        logistic_model = LRtorch(N, n_classes)
-        logistic_model = logistic_model.to(device)
+        n_classes = len(classes)
+        # the parameters are initialized with the precision of the model instead of the global default type of torch
+        logistic_model = LRtorch(N, n_classes, dtype=dtype)
+        logistic_model = logistic_model.to(device, dtype)
         logistic_model.train()
         optimizer = torch.optim.Adam(
             logistic_model.parameters(), lr=learning_rate, betas=betas, amsgrad=amsgrad
         )
+        if cached:
+            features, labelz, offsets, targets = get_features(loader, N, features_name, dtype=np_dtype, sparse=sparse, epsilon=epsilon, max_cache_size=max_cache_size, verbose=verbose)
+            if not os.path.isfile(features_name+'_classes.npy'):
+                np.save(features_name+'_classes', np.array(classes))
+            rng = np.random.default_rng(seed)
         if not verbose:
             pbar = tqdm(total=int(num_epochs))
         for epoch in range(int(num_epochs)):
             losses = []
-            for X, label in loader:
-                X, label = X.to(device), label.to(device)
-                X, label = X.squeeze(0), label.squeeze(0) # just one digit = one batch
-                X = X.reshape(X.shape[0], N)
+            if batch_size:
+                # mini-batches of events shuffled across samples (sorted indices to read the memory map in order)
+                permutation = rng.permutation(len(labelz))
+                batches = (np.sort(permutation[i:i+batch_size]) for i in range(0, len(labelz), batch_size))
+                if sparse:
+                    batches = ((get_sparse_rows(features, ind, N), torch.from_numpy(labelz[ind])) for ind in batches)
+                else:
+                    batches = ((torch.from_numpy(features[ind]), torch.from_numpy(labelz[ind])) for ind in batches)
+            elif cached:
+                # one sample per batch as with the loader, in a new random order at each epoch
+                batches = get_samples(features, offsets, targets, N, rng.permutation(len(targets)), sparse=sparse)
+            else:
+                batches = loader
+            for X, label in batches:
+                X, label = X.to(device, dtype), label.to(device)
+                if batch_size:
+                    labels = label
+                else:
+                    X, label = X[0], label[0] # just one digit = one batch
+                    if not X.is_sparse:
+                        X = X.reshape(X.shape[0], N)
+                    if sparse and not X.is_sparse:
+                        X = to_sparse(X, epsilon)
+                    n_events = X.shape[0]
+                    labels = label*torch.ones(n_events).type(torch.LongTensor).to(device)
 
                 outputs = logistic_model(X)
 
-                n_events = X.shape[0]
-                labels = label*torch.ones(n_events).type(torch.LongTensor).to(device)
-                labels = torch.nn.functional.one_hot(labels, num_classes=n_classes).type(torch.DoubleTensor).to(device)
+                labels = torch.nn.functional.one_hot(labels, num_classes=n_classes).to(device, dtype)
 
                 loss = criterion(outputs, labels)
                 optimizer.zero_grad()
@@ -256,6 +358,116 @@ def fit_MLR(tau_cla, #enter tau_cla in ms
 
     return logistic_model, losses
 
+def get_features_name(tau_cla, split, network=None, date=None, jitter=None, kfold=None, kfold_ind=0, seed=42, dtype=np.float32, sparse=False, epsilon=0):
+    # content-addressed name of the cached features: hash of the kernels of the network (or of the name of the raw
+    # dataset) and of all the parameters the features depend on
+    fingerprint = hashlib.sha1()
+    if network:
+        fingerprint.update(network.get_fname().encode())
+        for lay in range(len(network.L)):
+            fingerprint.update(np.ascontiguousarray(network.L[lay].kernel).tobytes())
+    else:
+        fingerprint.update(f'{date}_raw'.encode())
+    fingerprint.update(f'{tau_cla}_{split}_{jitter}_{kfold}_{kfold_ind}_{seed}_{np.dtype(dtype)}_{sparse}_{epsilon}'.encode())
+    return f'../Records/features/{fingerprint.hexdigest()}'
+
+def get_model_fingerprint(model):
+    # hash of the parameters of a model (values and precision), the outputs of the model are cached under this name
+    fingerprint = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        fingerprint.update(f'{name}_{tensor.dtype}'.encode())
+        fingerprint.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return fingerprint.hexdigest()[:10]
+
+def get_features(loader, N, f_name, dtype=np.float32, sparse=False, epsilon=0, max_cache_size=None, verbose=True):
+    # computes once the features (flattened time surfaces) of all the events of the loader and stores them in a
+    # memory-mapped file (one row per event), with the label of each event, the offsets of the samples and their
+    # targets. With sparse=True only the values above epsilon are stored (CSR format: values, column indices and
+    # offsets of the rows)
+    if not os.path.isfile(f_name+'_labels.npy'):
+        if verbose: print(f'computing the features: \n {f_name}')
+        os.makedirs(os.path.dirname(f_name), exist_ok=True)
+        labelz, targets, offsets, indptr = [], [], [0], [np.zeros(1, dtype=np.int64)]
+        with open(f_name+'.dat', 'wb') as file:
+            if sparse:
+                file_indices = open(f_name+'_indices.dat', 'wb')
+            for X, label in loader:
+                X = np.asarray(X.squeeze(0), dtype=dtype).reshape(-1, N)
+                if sparse:
+                    rows, cols = np.nonzero(X>epsilon)
+                    file.write(X[rows,cols].tobytes())
+                    file_indices.write(cols.astype(np.int32).tobytes())
+                    indptr.append(indptr[-1][-1]+np.cumsum(np.bincount(rows, minlength=X.shape[0])))
+                else:
+                    file.write(X.tobytes())
+                labelz.append(np.full(X.shape[0], int(label)))
+                targets.append(int(label))
+                offsets.append(offsets[-1]+X.shape[0])
+            if sparse:
+                file_indices.close()
+                np.save(f_name+'_indptr', np.concatenate(indptr))
+        np.save(f_name+'_offsets', np.array(offsets, dtype=np.int64))
+        np.save(f_name+'_targets', np.array(targets, dtype=np.int64))
+        # the labels are saved last, they mark a complete file of features
+        np.save(f_name+'_labels', np.concatenate(labelz))
+    else:
+        # the date of modification of the labels gives the last use of the features
+        os.utime(f_name+'_labels.npy')
+    if max_cache_size:
+        evict_features(os.path.dirname(f_name), max_cache_size, keep=os.path.basename(f_name))
+    labelz = np.load(f_name+'_labels.npy')
+    offsets = np.load(f_name+'_offsets.npy')
+    targets = np.load(f_name+'_targets.npy')
+    if sparse:
+        indptr = np.load(f_name+'_indptr.npy')
+        if indptr[-1]>0:
+            features = (np.memmap(f_name+'.dat', dtype=dtype, mode='r'), np.memmap(f_name+'_indices.dat', dtype=np.int32, mode='r'), indptr)
+        else:
+            features = (np.zeros(0, dtype=dtype), np.zeros(0, dtype=np.int32), indptr)
+    else:
+        features = np.memmap(f_name+'.dat', dtype=dtype, mode='r', shape=(len(labelz), N))
+    return features, labelz, offsets, targets
+
+def evict_features(path, max_cache_size, keep=None):
+    # removes the least recently used features of the cache until its size is below max_cache_size (in bytes)
+    sizes, last_use = {}, {}
+    for file in os.listdir(path):
+        f_name = file[:40] # name of the features: sha1 of their parameters
+        sizes[f_name] = sizes.get(f_name, 0)+os.path.getsize(os.path.join(path, file))
+        if file.endswith('_labels.npy'):
+            last_use[f_name] = os.path.getmtime(os.path.join(path, file))
+    total_size = sum(sizes.values())
+    for f_name in sorted(sizes, key=lambda name: last_use.get(name, 0)):
+        if total_size<=max_cache_size:
+            break
+        if f_name != keep:
+            for file in os.listdir(path):
+                if file.startswith(f_name):
+                    os.remove(os.path.join(path, file))
+            total_size -= sizes[f_name]
+
+def get_sparse_rows(features, ind, N):
+    # gathers the rows ind of sparse features stored by get_features as a sparse (COO) tensor
+    values, indices, indptr = features
+    starts, lengths = indptr[ind], indptr[ind+1]-indptr[ind]
+    rows = np.repeat(np.arange(len(ind)), lengths)
+    positions = np.repeat(starts-np.cumsum(lengths)+lengths, lengths)+np.arange(lengths.sum())
+    coordinates = torch.from_numpy(np.stack([rows, indices[positions].astype(np.int64)]))
+    return torch.sparse_coo_tensor(coordinates, torch.from_numpy(values[positions]), (len(ind), N))
+
+def get_samples(features, offsets, targets, N, order, sparse=False):
+    # cached features read sample by sample in the given order, as from a loader with batch_size=1
+    for i in order:
+        if sparse:
+            X = get_sparse_rows(features, np.arange(offsets[i],offsets[i+1]), N)
+        else:
+            X = torch.from_numpy(np.array(features[offsets[i]:offsets[i+1]]))
+        yield X[None], torch.tensor([targets[i]])
+
+def to_sparse(X, epsilon=0):
+    # converts a dense matrix of features to a sparse (COO) tensor, values below epsilon being set to zero
+    return (X*(X>epsilon)).to_sparse()
+
 def predict_MLR(model,
                 tau_cla, #enter tau_cla in ms
                 network = None,
@@ -267,13 +479,23 @@ def predict_MLR(model,
                 kfold_ind = 0,
                 num_workers = 0,
                 seed=42,
+                sparse=False,
+                epsilon=0,
+                cached_features=False, # the features of the test samples are computed once and kept in the cache (they
+                                       # are read from the cache whenever it holds them, even without this option)
+                max_cache_size=None,
                 verbose=True,
         ):
     
+    # the likelihoods depend on the parameters of the model (trained with a given batch_size, dtype, sparse...) and on
+    # the split of the samples
     if network:
-        results_name = f'../Records/output/classif/{network.get_fname()}_{int(tau_cla)}_{kfold}_{jitter}_LR.pkl'
+        f_name = f'{network.get_fname()}_{int(tau_cla)}_{kfold}_{kfold_ind}_{jitter}_{get_model_fingerprint(model)}'
     else:
-        results_name = f'../Records/output/classif/{date}_raw_{int(tau_cla)}_{kfold}_{jitter}_LR.pkl'
+        f_name = f'{date}_raw_{int(tau_cla)}_{kfold}_{kfold_ind}_{jitter}_{get_model_fingerprint(model)}'
+    if sparse:
+        f_name += f'_sparse_{epsilon}'
+    results_name = f'../Records/output/classif/{f_name}_LR.pkl'
     if verbose: print(results_name)    
     
     if os.path.isfile(results_name):
@@ -281,20 +503,28 @@ def predict_MLR(model,
             likelihood, true_target, timestamps = pickle.load(file) 
     else:    
         tau_cla*=1e3
+        dtype = next(model.parameters()).dtype
+        np_dtype = torch.empty(0, dtype=dtype).numpy().dtype
+        features_name = get_features_name(tau_cla, 'test', network=network, date=date, jitter=jitter, kfold=kfold, kfold_ind=kfold_ind, seed=seed, dtype=np_dtype, sparse=sparse, epsilon=epsilon)
+        cached = cached_features or os.path.isfile(features_name+'_labels.npy')
+        # the events of the samples are not read when their features and timestamps are in the cache
+        hit = os.path.isfile(features_name+'_labels.npy') and os.path.isfile(features_name+'_timestamps.npy')
         if network:
             path_to_dataset = f'../Records/output/test/{network.get_fname()}_{jitter}/'
             timesurface_size = (network.TS[0].camsize[0], network.TS[0].camsize[1], network.L[-1].kernel.shape[1])
-            transform = tonic.transforms.Compose([tonic.transforms.ToTimesurface(sensor_size=timesurface_size, tau=tau_cla, decay="exp")])
-            dataset = HOTS_Dataset(path_to_dataset, timesurface_size, transform=transform)
-            dataset_for_timestamps = HOTS_Dataset(path_to_dataset, timesurface_size, transform=tonic.transforms.NumpyAsType(int))#tonic.transforms.Compose([tonic.transforms.TimeAlignment()]))
+            if not hit:
+                transform = tonic.transforms.Compose([tonic.transforms.ToTimesurface(sensor_size=timesurface_size, tau=tau_cla, decay="exp")])
+                dataset = HOTS_Dataset(path_to_dataset, timesurface_size, transform=transform, lazy=True)
+                dataset_for_timestamps = HOTS_Dataset(path_to_dataset, timesurface_size, transform=tonic.transforms.NumpyAsType(int), lazy=True)#tonic.transforms.Compose([tonic.transforms.TimeAlignment()]))
         else:
             dataset = dataset_as_input 
             dataset_for_timestamps = dataset_for_timestamps_as_input
             timesurface_size = dataset.sensor_size
         shuffle=False
-        loader = get_loader(dataset, kfold = kfold, kfold_ind = kfold_ind, num_workers = num_workers, shuffle=shuffle, seed=seed)
-        loader_for_timestamps = get_loader(dataset_for_timestamps, kfold = kfold, kfold_ind = kfold_ind, num_workers = num_workers, shuffle=shuffle, seed=seed)
-        if verbose: print(f'Number of testing samples: {len(loader)}')
+        loader, loader_for_timestamps = None, None
+        if not hit:
+            loader = get_loader(dataset, kfold = kfold, kfold_ind = kfold_ind, num_workers = num_workers, shuffle=shuffle, seed=seed)
+            loader_for_timestamps = get_loader(dataset_for_timestamps, kfold = kfold, kfold_ind = kfold_ind, num_workers = num_workers, shuffle=shuffle, seed=seed)
 
         N = timesurface_size[0]*timesurface_size[1]*timesurface_size[2]
 
@@ -305,13 +535,23 @@ def predict_MLR(model,
 
             logistic_model = model.to(device)
 
-            if verbose:
-                pbar = tqdm(total=len(loader))
             likelihood, true_target, timestamps = [], [], []
+            if cached:
+                features, _, offsets, targets = get_features(loader, N, features_name, dtype=np_dtype, sparse=sparse, epsilon=epsilon, max_cache_size=max_cache_size, verbose=verbose)
+                nb_samples = len(targets)
+                loader = get_samples(features, offsets, targets, N, range(nb_samples), sparse=sparse)
+            else:
+                nb_samples = len(loader)
+            if verbose:
+                print(f'Number of testing samples: {nb_samples}')
+                pbar = tqdm(total=nb_samples)
 
             for X, label in loader:
-                X, label = X[0].to(device) ,label[0].to(device)
-                X = X.reshape(X.shape[0], N)
+                X, label = X[0].to(device, next(logistic_model.parameters()).dtype) ,label[0].to(device)
+                if not X.is_sparse:
+                    X = X.reshape(X.shape[0], N)
+                if sparse and not X.is_sparse:
+                    X = to_sparse(X, epsilon)
                 n_events = X.shape[0]
                 outputs = logistic_model(X)
                 likelihood.append(outputs.cpu().numpy())
@@ -321,9 +561,16 @@ def predict_MLR(model,
             if verbose:
                 pbar.close()
 
-            t_index = dataset_for_timestamps.ordering.index('t')
-            for events, target in loader_for_timestamps:
-                timestamps.append(events[0,:,t_index])
+            if hit:
+                timestamps_all = torch.from_numpy(np.load(features_name+'_timestamps.npy'))
+                timestamps = [timestamps_all[offsets[i]:offsets[i+1]] for i in range(nb_samples)]
+            else:
+                t_index = dataset_for_timestamps.ordering.index('t')
+                for events, target in loader_for_timestamps:
+                    timestamps.append(events[0,:,t_index])
+                if cached:
+                    # the timestamps are kept with the features (same offsets)
+                    np.save(features_name+'_timestamps', np.concatenate([np.zeros(0, dtype=np.int64)]+[np.asarray(timestamps_, dtype=np.int64) for timestamps_ in timestamps]))
 
             with open(results_name, 'wb') as file:
                 pickle.dump([likelihood, true_target, timestamps], file, pickle.HIGHEST_PROTOCOL)
@@ -332,48 +579,150 @@ def predict_MLR(model,
 
 class LRtorch(torch.nn.Module):
     #torch.nn.Module -> Base class for all neural network modules
-    def __init__(self, N, n_classes, bias=True):
+    def __init__(self, N, n_classes, bias=True, dtype=None):
         super(LRtorch, self).__init__()
-        self.linear = torch.nn.Linear(N, n_classes, bias=bias)
+        self.linear = torch.nn.Linear(N, n_classes, bias=bias, dtype=dtype)
         self.nl = torch.nn.Softmax(dim=1)
 
     def forward(self, factors):
+        if factors.is_sparse:
+            # sparse input: only the non zero features enter the matrix product
+            linear = torch.sparse.mm(factors, self.linear.weight.t())
+            if self.linear.bias is not None:
+                linear = linear+self.linear.bias
+            return self.nl(linear)
         return self.nl(self.linear(factors))
     
-def score_classif_events(likelihood, true_target, thres=None, verbose=True):
-    
-    max_len = 0
-    for likeli in likelihood:
-        if max_len<likeli.shape[0]:
-            max_len=likeli.shape[0]
-
-    matscor = np.zeros([len(true_target),max_len])
-    matscor[:] = np.nan
-    sample = 0
-    lastac = 0
-    nb_test = len(true_target)
-
-    for likelihood_, true_target_ in zip(likelihood, true_target):
-        pred_target = np.zeros(len(likelihood_))
-        pred_target[:] = np.nan
-        if not thres:
+class score_accumulator(object):
+    """accumulates the classification scores sample by sample (e.g. while predict_MLR runs): only the running counts
+    of correct and scored predictions for each event index (or each time step if timestep is given) are kept.
+    METHODS:
+             .update -> scores the likelihood of one sample (timestamps of its events needed with timestep)
+             .update_samples -> scores at once the samples of concatenated likelihoods given the offsets of the
+                        samples (without timestep)
+             .results -> returns meanac, onlinac, lastac, truepos, falsepos
+    """
+    def __init__(self, thres=None, timestep=None):
+        self.thres = thres
+        self.timestep = timestep
+        self.correct = np.zeros([0], dtype=np.int64) # number of correct predictions for each event index or time step
+        self.scored = np.zeros([0], dtype=np.int64)  # number of scored predictions
+        self.length = 0  # number of event indices seen
+        self.nb_test = 0
+        self.nb_last = 0 # number of correct last predictions
+        self.max_dur = 0
+        # time steps: last step of each sample with its prediction and the prediction at the step before, the steps
+        # after the end of the time axis (arange(0, max_dur, timestep)) are known once all samples are seen
+        self.last = []
+
+    def grow(self, length):
+        # the counts are extended by doubling their size
+        if length>len(self.correct):
+            size = max(length, 2*len(self.correct))
+            self.correct = np.append(self.correct, np.zeros(size-len(self.correct), dtype=np.int64))
+            self.scored = np.append(self.scored, np.zeros(size-len(self.scored), dtype=np.int64))
+        self.length = max(length, self.length)
+
+    def update(self, likelihood_, true_target_, timestamps_=None):
+        likelihood_ = np.asarray(likelihood_)
+        self.nb_test += 1
+        if self.timestep is None:
             pred_target = np.argmax(likelihood_, axis = 1)
+            if not self.thres:
+                scored = np.ones(len(pred_target), dtype=bool)
+            else:
+                scored = np.max(likelihood_, axis = 1)>self.thres
+            correct = (pred_target==true_target_)&scored
+            self.grow(len(pred_target))
+            self.correct[:len(correct)] += correct
+            self.scored[:len(scored)] += scored
+            if len(correct) and correct[-1]:
+                self.nb_last += 1
+            return
+
+        timestamps_ = np.asarray(timestamps_)
+        if len(timestamps_):
+            self.max_dur = max(self.max_dur, timestamps_[-1])
+        # index of the time step of each event: (step-1)*timestep < t <= step*timestep
+        steps = np.ceil(timestamps_/self.timestep).astype(np.int64)
+        inside = steps>=1
+        order = np.argsort(steps[inside], kind='stable')
+        steps, likelihood_ = steps[inside][order], likelihood_[inside][order]
+        # mean (and max) of the likelihood of the events of each non empty time step
+        steps, starts = np.unique(steps, return_index=True)
+        mean_likelihood = np.add.reduceat(likelihood_, starts, axis=0)/np.diff(np.append(starts, len(likelihood_)))[:,None]
+        valid = ~np.isnan(mean_likelihood).any(axis=1)
+        steps, mean_likelihood = steps[valid], mean_likelihood[valid]
+        pred_timestep = np.argmax(mean_likelihood, axis=1)
+        if self.thres:
+            max_likelihood = np.maximum.reduceat(likelihood_, starts, axis=0)[valid]
+            keep = max_likelihood[np.arange(len(steps)),pred_timestep]>self.thres
+            steps, pred_timestep = steps[keep], pred_timestep[keep]
+        correct = pred_timestep==true_target_
+        self.grow(steps[-1]+1 if len(steps) else 0)
+        self.correct[steps] += correct
+        self.scored[steps] += 1
+        if len(steps):
+            self.last.append((steps[-1], correct[-1], len(steps)>1 and correct[-2]))
+
+    def update_samples(self, likelihood, true_target, offsets):
+        # vectorized update over samples: each event of the concatenated likelihoods is indexed by its position in its
+        # sample, the counts by position come from bincounts and the last prediction is the one at the end of a sample
+        assert self.timestep is None, 'the samples are scored at once by event index only'
+        likelihood = np.asarray(likelihood)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        lengths = np.diff(offsets)
+        self.nb_test += len(lengths)
+        if not offsets[-1]-offsets[0]:
+            return
+        likelihood = likelihood[offsets[0]:offsets[-1]]
+        position = np.arange(len(likelihood))-np.repeat(offsets[:-1]-offsets[0], lengths)
+        targets = np.repeat(np.asarray(true_target, dtype=np.int64).reshape(-1), lengths)
+        pred_target = np.argmax(likelihood, axis = 1)
+        length = int(lengths.max())
+        self.grow(length)
+        if not self.thres:
+            correct = pred_target==targets
+            # all events are scored: the count at a position is the number of samples longer than the position
+            self.scored[:length] += np.cumsum(np.bincount(lengths, minlength=length+1)[::-1])[::-1][1:]
         else:
-            for i in range(len(likelihood_)):
-                if np.max(likelihood_[i])>thres:
-                    pred_target[i] = np.argmax(likelihood_[i])
-        for event in range(len(pred_target)):
-            if np.isnan(pred_target[event])==False:
-                matscor[sample,event] = pred_target[event]==true_target_
-        if pred_target[-1]==true_target_:
-            lastac+=1
-        sample+=1
-
-    meanac = np.nanmean(matscor)
-    onlinac = np.nanmean(matscor, axis=0)
-    lastac/=nb_test
-    truepos = len(np.where(matscor==1)[0])
-    falsepos = len(np.where(matscor==0)[0])
+            scored = np.max(likelihood, axis = 1)>self.thres
+            correct = (pred_target==targets)&scored
+            self.scored[:length] += np.bincount(position[scored], minlength=length)
+        self.correct[:length] += np.bincount(position[correct], minlength=length)
+        self.nb_last += int(correct[offsets[1:][lengths>0]-offsets[0]-1].sum())
+
+    def results(self):
+        if self.timestep is None:
+            length = self.length
+            nb_last = self.nb_last
+        else:
+            # only the time steps of arange(0, max_dur, timestep) are scored
+            length = len(np.arange(0, self.max_dur, self.timestep))
+            nb_last = sum(correct if step<length else correct_prev for step, correct, correct_prev in self.last)
+        correct, scored = self.correct[:length], self.scored[:length]
+        if len(correct)<length:
+            correct, scored = np.append(correct, np.zeros(length-len(correct))), np.append(scored, np.zeros(length-len(scored)))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            onlinac = correct/scored
+        truepos = int(correct.sum())
+        falsepos = int(scored.sum())-truepos
+        meanac = truepos/(truepos+falsepos) if truepos+falsepos else np.nan
+        lastac = nb_last/self.nb_test if self.nb_test else np.nan
+        return meanac, onlinac, lastac, truepos, falsepos
+
+def score_classif_events(likelihood, true_target, thres=None, chunk=2**16, verbose=True):
+    
+    # the likelihoods of successive samples are concatenated by groups of about chunk events and scored at once
+    scores = score_accumulator(thres=thres)
+    offsets = np.append(0, np.cumsum([len(likelihood_) for likelihood_ in likelihood])).astype(np.int64)
+    start = 0
+    while start<len(likelihood):
+        stop = max(np.searchsorted(offsets, offsets[start]+chunk, side='right')-1, start+1)
+        group = [np.asarray(likelihood_) for likelihood_ in likelihood[start:stop] if len(likelihood_)]
+        scores.update_samples(np.concatenate(group) if group else np.zeros([0,1]), true_target[start:stop], offsets[start:stop+1]-offsets[start])
+        start = stop
+    meanac, onlinac, lastac, truepos, falsepos = scores.results()
 
     if verbose:
         print(f'Mean accuracy: {np.round(meanac,3)*100}%')
@@ -386,54 +735,18 @@ def score_classif_events(likelihood, true_target, thres=None, verbose=True):
 
 def score_classif_time(likelihood, true_target, timestamps, timestep, thres=None, verbose=True):
     
-    max_dur = 0
-    for time in timestamps:
-        if max_dur<time[-1]:
-            max_dur=time[-1]
-            
-    time_axis = np.arange(0,max_dur,timestep)
-
-    matscor = np.zeros([len(true_target),len(time_axis)])
-    matscor[:] = np.nan
-    sample = 0
-    lastac = 0
-    nb_test = len(true_target)
+    scores = score_accumulator(thres=thres, timestep=timestep)
     
     if verbose: pbar = tqdm(total=len(likelihood))
     
     for likelihood_, true_target_, timestamps_ in zip(likelihood, true_target, timestamps):
-        pred_timestep = np.zeros(len(time_axis))
-        pred_timestep[:] = np.nan
-        for step in range(1,len(pred_timestep)):
-            indices = np.where((timestamps_.numpy()<=time_axis[step])&(timestamps_.numpy()>time_axis[step-1]))[0]
-            mean_likelihood = np.mean(likelihood_[indices,:],axis=0)
-            if np.isnan(mean_likelihood).sum()>0:
-                pred_timestep[step] = np.nan
-            else:
-                if not thres:
-                    pred_timestep[step] = np.nanargmax(mean_likelihood)
-                elif np.max(likelihood_[indices,np.nanargmax(mean_likelihood)])>thres:
-                    pred_timestep[step] = np.nanargmax(mean_likelihood)
-                else:
-                    pred_timestep[step] = np.nan
-            if not np.isnan(pred_timestep[step]):
-                matscor[sample,step] = pred_timestep[step]==true_target_
-        
-        lastev = -1
-        while np.isnan(pred_timestep[lastev]):
-            lastev -= 1
-        if pred_timestep[lastev]==true_target_:
-            lastac+=1
+        scores.update(likelihood_, true_target_, timestamps_)
         if verbose: pbar.update(1)
-        sample+=1
        
     if verbose: pbar.close()
     
-    meanac = np.nanmean(matscor)
-    onlinac = np.nanmean(matscor, axis=0)
-    lastac/=nb_test
-    truepos = len(np.where(matscor==1)[0])
-    falsepos = len(np.where(matscor==0)[0])
+    meanac, onlinac, lastac, truepos, falsepos = scores.results()
+    time_axis = np.arange(0, scores.max_dur, timestep)
         
     if verbose:
         print(f'Mean accuracy: {np.round(meanac,3)*100}%')
@@ -444,8 +757,149 @@ def score_classif_time(likelihood, true_target, timestamps, timestep, thres=None
     
     return meanac, onlinac, lastac, truepos, falsepos
 
+## JITTER
+
+def jitter_sweep(model,
+                 tau_cla, #enter tau_cla in ms
+                 testset,
+                 network = None,
+                 date = None,
+                 jitter_s = (), # variances of the spatial jitter (in pixels²)
+                 jitter_t = (), # variances of the temporal jitter (in µs²)
+                 nb_trials = 1,
+                 indices = None, # indices of the test samples (all of them if None)
+                 seed = 42,
+                 thres = None,
+                 n_jobs = 1,
+                 verbose = True,
+        ):
+    # robustness of the classification to jitter: the test samples are decoded once and each (jitter, trial) is run
+    # through the network (raw events if network is None) and the LR model and scored on the fly by a worker of the pool.
+    # The shifts of the events only depend on the seed, the trial and the sample, the jitter levels scale the same draws.
+    # The samples without output events are counted at chance level in meanac and as wrong in lastac (as in
+    # classification_results), scored gives the number of samples with output events.
+    levels = [('spatial', jit) for jit in jitter_s]+[('temporal', jit) for jit in jitter_t]
+    if indices is None:
+        indices = range(len(testset))
+    fingerprint = hashlib.sha1(f'{get_model_fingerprint(model)}_{levels}_{nb_trials}_{list(indices)}_{seed}_{thres}'.encode()).hexdigest()[:10]
+    if network:
+        results_name = f'../Records/results/{network.get_fname()}_{int(tau_cla)}_{fingerprint}_jitter.pkl'
+    else:
+        results_name = f'../Records/results/{date}_raw_{int(tau_cla)}_{fingerprint}_jitter.pkl'
+    if verbose: print(results_name)
+
+    if os.path.isfile(results_name):
+        with open(results_name, 'rb') as file:
+            table = pickle.load(file)
+        return table
+
+    if network:
+        sensor_size = network.TS[0].camsize
+        timesurface_size = (sensor_size[0], sensor_size[1], network.L[-1].kernel.shape[1])
+    else:
+        sensor_size = testset.sensor_size
+        timesurface_size = testset.sensor_size
+    chance = 1/len(testset.classes)
+    transform = tonic.transforms.Compose([tonic.transforms.ToTimesurface(sensor_size=timesurface_size, tau=tau_cla*1e3, decay="exp")])
+    samples = []
+    for index in indices:
+        events, target = testset[index]
+        samples.append((get_xytp(events, testset.ordering), int(target)))
+
+    tasks = [(kind, jit, trial) for kind, jit in levels for trial in range(nb_trials)]
+    if verbose: pbar = tqdm(total=len(tasks))
+    if n_jobs>1:
+        pool = multiprocessing.Pool(n_jobs, initializer=init_jitter, initargs=(model, network, transform, samples, sensor_size, timesurface_size, seed, thres, chance, True))
+        outputs = pool.imap_unordered(run_jitter, tasks)
+    else:
+        pool = None
+        init_jitter(model, network, transform, samples, sensor_size, timesurface_size, seed, thres, chance)
+        outputs = map(run_jitter, tasks)
+    rows = []
+    for row in outputs:
+        rows.append(row)
+        if verbose: pbar.update(1)
+    if pool:
+        pool.close()
+        pool.join()
+    if verbose: pbar.close()
 
-## OTHER 
+    table = np.array(sorted(rows), dtype=[('kind','U8'), ('jitter',float), ('trial',int), ('meanac',float), ('lastac',float), ('scored',int)])
+    os.makedirs('../Records/results/', exist_ok=True)
+    with open(results_name, 'wb') as file:
+        pickle.dump(table, file, pickle.HIGHEST_PROTOCOL)
+    return table
+
+def get_xytp(events, ordering='xytp'):
+    # events of one sample as an array of int64 with columns (x, y, t, p)
+    events = np.asarray(events).squeeze()
+    if events.dtype.names:
+        return np.stack([events[name] for name in 'xytp'], axis=1).astype(np.int64)
+    return events[:,[ordering.index(name) for name in 'xytp']].astype(np.int64)
+
+def jitter_events(events, var_s, var_t, shifts, sensor_size):
+    # the normal shifts (one row per event for x, y and t) are scaled by the standard deviation of the jitter,
+    # the events outside of the sensor or with negative timestamps are dropped and the others sorted by time
+    events = events.copy()
+    events[:,:2] += np.round(np.sqrt(var_s)*shifts[:,:2]).astype(np.int64)
+    events[:,2] += np.round(np.sqrt(var_t)*shifts[:,2]).astype(np.int64)
+    inside = (events[:,0]>=0)&(events[:,0]<sensor_size[0])&(events[:,1]>=0)&(events[:,1]<sensor_size[1])&(events[:,2]>=0)
+    events = events[inside]
+    return events[np.argsort(events[:,2], kind='stable')]
+
+jitter_parameters = None
+
+def limit_threads():
+    # the workers of a pool run in parallel, torch and the BLAS used by numpy should not spawn threads in each of them
+    torch.set_num_threads(1)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(1)
+
+def init_jitter(model, network, transform, samples, sensor_size, timesurface_size, seed, thres, chance, single_thread=False):
+    # each worker of the pool keeps the decoded test samples, the network and the LR model
+    global jitter_parameters
+    if single_thread:
+        limit_threads()
+    jitter_parameters = model, network, transform, samples, sensor_size, timesurface_size, seed, thres, chance
+
+def run_jitter(task):
+    kind, jit, trial = task
+    model, network, transform, samples, sensor_size, timesurface_size, seed, thres, chance = jitter_parameters
+    var_s, var_t = (jit, 0) if kind=='spatial' else (0, jit)
+    N = timesurface_size[0]*timesurface_size[1]*timesurface_size[2]
+    dtype = next(model.parameters()).dtype
+    device = next(model.parameters()).device
+    scores = score_accumulator(thres=thres)
+    nb_scored = 0
+    with torch.no_grad():
+        for index, (events, target) in enumerate(samples):
+            shifts = np.random.default_rng([seed, trial, index]).standard_normal((len(events), 3))
+            events = jitter_events(events, var_s, var_t, shifts, sensor_size)
+            if network:
+                events = list(network.stream(events))
+                # the samples without output events can not be scored by the model
+                if not events:
+                    continue
+                events = np.concatenate(events)
+            elif not len(events):
+                continue
+            X = transform(np.lib.recfunctions.unstructured_to_structured(events, HOTS_Dataset.dtype))
+            X = torch.as_tensor(np.asarray(X)).to(device, dtype).reshape(len(events), N)
+            scores.update(model(X).cpu().numpy(), target)
+            nb_scored += 1
+    meanac, onlinac, lastac, truepos, falsepos = scores.results()
+    # the samples that were not scored are at chance level
+    nb_test = len(samples)
+    if nb_scored<nb_test:
+        meanac = (nb_scored*meanac+(nb_test-nb_scored)*chance)/nb_test if nb_scored else chance
+    lastac = scores.nb_last/nb_test
+    return kind, float(jit), trial, meanac, lastac, nb_scored
+
+
+## OTHER
 # classif avec histogram
 
 def fit_histo(network, 
@@ -458,31 +912,17 @@ def fit_histo(network,
         return
     
     timesurface_size = (network.TS[0].camsize[0], network.TS[0].camsize[1], network.L[-1].kernel.shape[1])
-    dataset = HOTS_Dataset(path_to_dataset, timesurface_size, transform=tonic.transforms.NumpyAsType(int))
-    loader = get_loader(dataset, num_workers = num_workers)
-    if verbose: print(f'Number of training samples: {len(loader)}')
-    model_name = f'../Records/models/{network.get_fname()}_{len(loader)}_histo.pkl' 
+    dataset = HOTS_Dataset(path_to_dataset, timesurface_size, lazy=True)
+    if verbose: print(f'Number of training samples: {len(dataset)}')
+    model_name = f'../Records/models/{network.get_fname()}_{len(dataset)}_histo.pkl' 
 
     if os.path.isfile(model_name):
         if verbose: print('load existing histograms')
         with open(model_name, 'rb') as file:
             histo, labelz = pickle.load(file)
     else:
-        p_index = dataset.ordering.index('p')
-        #n_classes = len(dataset.classes)
         n_polarity = timesurface_size[2]
-        histo = np.zeros([len(loader),n_polarity])
-        labelz = []
-        pbar = tqdm(total=len(loader))
-        sample_number = 0
-        for events, label in loader:
-            events, label = events.squeeze(0), label.squeeze(0) # just one digit = one batch
-            labelz.append(label)
-            value, frequency = np.unique(events[:,p_index], return_counts=True)
-            histo[sample_number,value] = frequency
-            sample_number+=1
-            pbar.update(1)
-        pbar.close()
+        histo, labelz = get_histo(dataset, n_polarity)
         with open(model_name, 'wb') as file:
             pickle.dump([histo, labelz], file, pickle.HIGHEST_PROTOCOL)
 
@@ -501,24 +941,11 @@ def predict_histo(network,
         print('process samples with the HOTS network first')
         return
     timesurface_size = (network.TS[0].camsize[0], network.TS[0].camsize[1], network.L[-1].kernel.shape[1])
-    dataset = HOTS_Dataset(path_to_dataset, timesurface_size, transform=tonic.transforms.NumpyAsType(int))
-    loader = get_loader(dataset, num_workers = num_workers)
-    if verbose: print(f'Number of testing samples: {len(loader)}')
+    dataset = HOTS_Dataset(path_to_dataset, timesurface_size, lazy=True)
+    if verbose: print(f'Number of testing samples: {len(dataset)}')
     
-    p_index = dataset.ordering.index('p')
     n_polarity = timesurface_size[2]
-    histo_test = np.zeros([len(loader),n_polarity])
-    labelz_true = []
-    if verbose: pbar = tqdm(total=len(loader))
-    sample_number = 0
-    for events, label in loader:
-        events, label = events.squeeze(0), label.squeeze(0) # just one digit = one batch
-        labelz_true.append(label)
-        value, frequency = np.unique(events[:,p_index], return_counts=True)
-        histo_test[sample_number,value] = frequency
-        sample_number += 1
-        if verbose: pbar.update(1)
-    if verbose: pbar.close()
+    histo_test, labelz_true = get_histo(dataset, n_polarity)
     
     histo_train = (histo_train.T/np.sum(histo_train, axis=1)).T
     histo_test = (histo_test.T/np.sum(histo_test, axis=1)).T
@@ -534,4 +961,21 @@ def predict_histo(network,
     #elif measure == 'EMD':
     #https://mathoverflow.net/questions/103115/distance-metric-between-two-sample-distributions-histograms
     
-    return accuracy
\ No newline at end of file
+    return accuracy
+
+def get_histo(dataset, n_polarity, chunk=2**24):
+    # histograms of the polarities of the events of all samples of a HOTS_Dataset, with the targets of the samples
+    p_index = dataset.ordering.index('p')
+    histo = np.zeros([len(dataset),n_polarity])
+    if dataset.offsets is not None:
+        # consolidated output: the events of all samples are counted at once (by chunks), indexed by their sample
+        if dataset.offsets[-1]:
+            events = dataset.get_events()
+            for start in range(0, dataset.offsets[-1], chunk):
+                stop = min(start+chunk, dataset.offsets[-1])
+                sample = np.searchsorted(dataset.offsets, np.arange(start, stop), side='right')-1
+                histo += np.bincount(sample*n_polarity+events[start:stop,p_index], minlength=histo.size).reshape(histo.shape)
+    else:
+        for index in range(len(dataset)):
+            histo[index] = np.bincount(dataset.load(index)[:,p_index].astype(int), minlength=n_polarity)
+    return histo, np.array(dataset.targets)
@@ -0,0 +1,70 @@
+import numpy as np
+import time
+import sys
+sys.path.append('../HOTS')
+import network as hotsnetwork
+from network import network
+from layer import layer
+from timesurface import timesurface
+
+# compares the two paths of network.runchunk with frozen kernels: a whole chunk through a layer (batch_surfaces and
+# predict_batch) or the events one by one (addevent and run), to set network.BATCH_MAXDIM
+
+def get_events(nb_events, camsize, nbpol, rate, seed):
+    rng = np.random.default_rng(seed)
+    events = np.zeros([nb_events,4], dtype=np.int64)
+    events[:,0] = rng.integers(0, camsize[0], nb_events)
+    events[:,1] = rng.integers(0, camsize[1], nb_events)
+    events[:,2] = np.sort(rng.integers(0, nb_events*rate, nb_events))
+    events[:,3] = rng.integers(0, nbpol, nb_events)
+    return events
+
+def time_layer(events, camsize, nbpol, R, nbclust, homeo, chunksize):
+    timing = []
+    for batch in [True, False]:
+        np.random.seed(0)
+        TS = timesurface(R, 1e3, camsize, nbpol, None, 'exponential', storage='timestamp')
+        L = layer(R, nbclust, nbpol, homeo, 'lagorce', 'rdn', camsize, False)
+        start = time.time()
+        for i in range(0, len(events), chunksize):
+            chunk = np.zeros(len(events[i:i+chunksize]), dtype=[('x',np.int64),('y',np.int64),('t',np.int64),('p',np.int64)])
+            chunk['x'], chunk['y'], chunk['t'], chunk['p'] = events[i:i+chunksize].T
+            if batch:
+                timesurf, activ = TS.batch_surfaces(chunk, dtype=np.float64)
+                L.predict_batch(timesurf[activ])
+            else:
+                for xev, yev, tev, pev in events[i:i+chunksize]:
+                    timesurf = TS.addevent(int(xev), int(yev), int(tev), int(pev))
+                    if len(timesurf)>0:
+                        L.run(timesurf, False)
+        timing.append(time.time()-start)
+    return timing
+
+def time_network(events, name, maxdim, chunksize):
+    np.random.seed(0)
+    net = network(name=name, timestr='benchmark')
+    hotsnetwork.BATCH_MAXDIM = maxdim
+    start = time.time()
+    for events_output in net.stream(events, chunksize=chunksize):
+        pass
+    return time.time()-start
+
+if __name__ == '__main__':
+    nb_events = 20000
+    chunksize = 1000
+    homeo = (.25, 1)
+    nbclust = 16
+    #_______________LAYER BY LAYER_________________
+    print(f'{nb_events} events, chunks of {chunksize} events - time (s) of one layer on the whole chunk / event by event')
+    for camsize in [(34,34), (120,100)]:
+        for nbpol, R in [(2,2), (4,2), (2,4), (8,2), (4,4), (8,4), (2,8), (16,4), (4,8), (8,8), (16,8)]:
+            events = get_events(nb_events, camsize, nbpol, 50, 0)
+            batch, event = time_layer(events, camsize, nbpol, R, nbclust, homeo, chunksize)
+            print(f'{camsize} P={nbpol:2} R={R} P(2R+1)^2={nbpol*(2*R+1)**2:5}: {batch:6.2f} / {event:6.2f}')
+    #_______________WHOLE NETWORK__________________
+    default = hotsnetwork.BATCH_MAXDIM
+    events = get_events(nb_events, (34,34), 2, 50, 0)
+    for name in ['hots', 'homhots']:
+        for label, maxdim in [('whole chunks', np.inf), ('event by event', 0), (f'BATCH_MAXDIM={default}', default)]:
+            print(f'{name} (34, 34) - {label}: {time_network(events, name, maxdim, chunksize):.2f}s')
+    hotsnetwork.BATCH_MAXDIM = default